@@ -0,0 +1,65 @@
+"""Times decoding images to the thumbnail and main view widths: a full decode and resize against imaging.open_scaled
+
+    python bench_decode.py [-n NUMBER] [IMAGE.jpg ...]
+
+Without images synthetic JPEGs of typical thumbnail and original sizes are used.
+"""
+
+import argparse
+import io
+import random
+import timeit
+
+from PIL import Image, ImageFilter
+
+from imaging import RESAMPLE_MODES, open_scaled
+
+NUMBER = 10
+SIZES = ((300, 400), (1280, 960), (2400, 3200), (4000, 6000))
+WIDTHS = (120, 450)
+
+
+def build_jpeg(size):
+    """Noise blurred into something with edges and gradients, photos compress about like it"""
+    rnd = random.Random(size[0])
+    small = Image.frombytes('RGB', (size[0] // 16, size[1] // 16), rnd.randbytes(size[0] // 16 * (size[1] // 16) * 3))
+    img = small.resize(size, Image.BICUBIC).filter(ImageFilter.DETAIL)
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def decode_full(data, width):
+    """What the viewer did before: decode the whole image, then resize it"""
+    img = Image.open(io.BytesIO(data))
+    w, h = img.size
+    return img.resize((width, int(h * width / w)))
+
+
+def bench(label, data, number):
+    for width in WIDTHS:
+        before = timeit.timeit(lambda: decode_full(data, width), number=number) / number
+        line = f"{label} -> {width}: full decode {before * 1000:.1f} ms"
+        for mode in RESAMPLE_MODES:
+            after = timeit.timeit(lambda: open_scaled(io.BytesIO(data), width, mode), number=number) / number
+            line += f", {mode} {after * 1000:.1f} ms {before / after:.1f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decoding images at the viewer sizes")
+    parser.add_argument('images', nargs='*', help="image files")
+    parser.add_argument('-n', '--number', type=int, default=NUMBER, help="runs per measurement")
+    args = parser.parse_args()
+
+    if len(args.images) == 0:
+        for size in SIZES:
+            bench(f'{size[0]}x{size[1]}', build_jpeg(size), args.number)
+
+    for filename in args.images:
+        with open(filename, 'rb') as f:
+            bench(filename, f.read(), args.number)
+
+
+if __name__ == "__main__":
+    main()
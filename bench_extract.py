@@ -0,0 +1,75 @@
+"""Times the variable lookups of one page resolution: a search() per variable against one get_variables() scan
+
+    python bench_extract.py [-n NUMBER] [PAGE.html ...]
+
+Pages saved with fetch.DEBUG = True (1.html, 2.html) are the realistic input, without any a synthetic page
+of the same shape is used.
+"""
+
+import argparse
+import random
+import re
+import string
+import timeit
+
+from page import get_variables
+
+NUMBER = 200
+
+
+def build_page(size=60 * 1024, count=21):
+    """Script assignments scattered through filler markup, like the redirect and post pages"""
+    rnd = random.Random(1)
+    names = ['_0x%06x' % rnd.getrandbits(24) for _ in range(count)]
+    parts = []
+    for i, name in enumerate(names):
+        filler = ''.join(rnd.choice(string.ascii_letters + ' <>/="\n') for _ in range(size // count))
+        quote = '"' if i % 2 == 0 else "'"
+        value = ''.join(rnd.choice(string.ascii_letters + string.digits) for _ in range(12))
+        parts.append(f'<div class="x">{filler}</div><script>var {name}={quote}{value}{quote};</script>\n')
+
+    return ''.join(parts)
+
+
+def search_each(html, names):
+    """What the providers did before: one full scan of the page per variable"""
+    values = {}
+    for name, quote in names:
+        found = re.search(f'{name}={quote}(.*?){quote}', html, re.MULTILINE | re.DOTALL)
+        values[name] = '' if found is None else found.group(1)
+
+    return values
+
+
+def get_names(html):
+    return [(found.group(1), found.group(2)) for found in re.finditer(r'''(_0x\w+)=(["'])''', html)]
+
+
+def bench(label, html, number):
+    names = get_names(html)
+    if search_each(html, names) != {name: get_variables(html)[name] for name, _ in names}:
+        print(f"{label}: results differ")
+
+    before = timeit.timeit(lambda: search_each(html, names), number=number) / number
+    after = timeit.timeit(lambda: get_variables(html), number=number) / number
+    print(f"{label}: {len(html) // 1024} KiB, {len(names)} variables, "
+          f"search per variable {before * 1000:.3f} ms, single pass {after * 1000:.3f} ms, "
+          f"{before / after:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the obfuscated variable extraction")
+    parser.add_argument('pages', nargs='*', help="saved provider pages")
+    parser.add_argument('-n', '--number', type=int, default=NUMBER, help="runs per measurement")
+    args = parser.parse_args()
+
+    if len(args.pages) == 0:
+        bench('synthetic', build_page(), args.number)
+
+    for filename in args.pages:
+        with open(filename, encoding='utf-8') as f:
+            bench(filename, f.read(), args.number)
+
+
+if __name__ == "__main__":
+    main()
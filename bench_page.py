@@ -0,0 +1,100 @@
+"""Times building the page model: one search per field against the single pass of page.scan_page
+
+    python bench_page.py [-n NUMBER] [DOMEN=PAGE.html ...]
+
+Final pages are saved as 3.html with fetch.DEBUG = True, e.g. imgrock=3.html. Without pages a synthetic
+final page is built for every provider.
+"""
+
+import argparse
+import random
+import string
+import timeit
+
+from page import PageModel, get_links, get_more_from_author, get_more_from_gallery, get_next_url, get_prev_url, \
+    get_thumb, search
+from providers import IMAGE_FROM_VARIABLES, SPECS, get_provider
+
+NUMBER = 200
+
+
+def get_model_by_field(html, provider):
+    """The model as it was built before scan_page, every field scanning the page on its own"""
+    return PageModel(thumb_url=get_thumb(html),
+                     image_url=provider.get_image_url(html),
+                     gallery_url=search('href="([^"]*)">More from gallery</a>', html),
+                     prev_url=get_prev_url(html),
+                     next_url=get_next_url(html),
+                     author_links=get_links(get_more_from_author(html)),
+                     gallery_links=get_links(get_more_from_gallery(html)))
+
+
+def build_page(spec, size=48 * 1024):
+    rnd = random.Random(spec.domen)
+    host = spec.hosts[0]
+
+    def word():
+        return ''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(2, 9)))
+
+    def filler(length):
+        parts = []
+        while length > 0:
+            part = f'<div class="{word()}"><p>{" ".join(word() for _ in range(12))}</p></div>\n'
+            parts.append(part)
+            length -= len(part)
+        return ''.join(parts)
+
+    def panel(align):
+        cells = ''.join(f'<td><a href="https://{host}/{word()}/{word()}.jpg.html">'
+                        f'<img src="https://t.{host}/th/{word()}_t.jpg" border="0"></a></td>'
+                        + ('</tr><tr>' if i % 2 else '') for i in range(8))
+        return f'<td align="{align}" valign="top"><b>{word()}</b><table><tr>{cells}</tr></table></td>\n'
+
+    script = ''
+    if spec.image == IMAGE_FROM_VARIABLES:
+        script = f'<script>var _0xDB36="https://i.{host}";var _0xDB54="{word()}.jpg";</script>\n'
+
+    return (f'<html><head>{script}</head><body>{filler(size // 2)}<table><tr>\n'
+            + panel('left')
+            + f'<td align="center"><a style="float:left" href="https://{host}/{word()}/p.jpg.html">'
+              f'<span class="nav">< Previous</span></a>\n'
+              f'<a style="float:right" href="https://{host}/{word()}/n.jpg.html"><span class="nav">Next ></span></a>'
+              f'<br><img src="https://i.{host}/img/{word()}.jpg" class="picview" alt="{word()}">\n'
+              f'{filler(size // 4)}<textarea>[URL=https://{host}/][IMG]https://t.{host}/th/{word()}_t.jpg[/IMG]'
+              f'[/URL]</textarea>\n'
+              f'<a href="https://{host}/g/{word()}">More from gallery</a></td>\n'
+            + panel('right')
+            + f'</tr></table>{filler(size // 4)}</body></html>')
+
+
+def bench(label, html, provider, number):
+    before_model = get_model_by_field(html, provider)
+    after_model = PageModel.from_html(html, provider)
+    for name in PageModel.__slots__:
+        if getattr(before_model, name) != getattr(after_model, name):
+            print(f"{label}: {name} differs")
+
+    before = timeit.timeit(lambda: get_model_by_field(html, provider), number=number) / number
+    after = timeit.timeit(lambda: PageModel.from_html(html, provider), number=number) / number
+    print(f"{label}: {len(html) // 1024} KiB, search per field {before * 1000:.3f} ms, "
+          f"single pass {after * 1000:.3f} ms, {before / after:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark building the page model")
+    parser.add_argument('pages', nargs='*', help="DOMEN=FILE of saved final pages")
+    parser.add_argument('-n', '--number', type=int, default=NUMBER, help="runs per measurement")
+    args = parser.parse_args()
+
+    if len(args.pages) == 0:
+        for spec in SPECS:
+            bench(spec.domen, build_page(spec), get_provider(spec.hosts[0]), args.number)
+
+    for arg in args.pages:
+        domen, filename = arg.split('=', 1)
+        with open(filename, encoding='utf-8') as f:
+            bench(f'{domen} {filename}', f.read(), get_provider(domen + '.pw'), args.number)
+
+
+if __name__ == "__main__":
+    main()
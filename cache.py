@@ -0,0 +1,778 @@
+import atexit
+import hashlib
+import io
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+GiB = 1024 * 1024 * 1024
+
+# byte budget per provider directory, overrides are keyed by provider domen
+DEFAULT_BUDGET = 2 * GiB
+BUDGETS = {}
+
+# evict down to this fraction of the budget so we don't evict on every put
+LOW_WATER = 0.9
+
+# access times are collected in memory and written to the index this often
+FLUSH_INTERVAL = 5
+INDEX = 'index.sqlite'
+# downloads in progress, cache/partial/<domen>/<key>, kept until complete so they can be resumed
+PARTIAL = 'partial'
+# next to a partial download, the ETag or Last-Modified of the response it was started from
+VALIDATOR = '.validator'
+
+# seconds an entry of a content type is served without revalidation, None means it never goes stale
+FRESHNESS = {
+    'gallery': 60 * 60,
+    'page': None,
+    'thumb': None,
+    'image': None,
+}
+
+# pages and images that answered 404 or "File Not Found" aren't requested again for this long
+DEAD_TTL = 24 * 60 * 60
+# the evictor deletes expired dead marks this often
+PURGE_INTERVAL = 60 * 60
+
+# entry format: magic, version, flags, reserved, then the payload
+MAGIC = b'IMGC'
+VERSION = 1
+HEADER = struct.Struct('<4sBBH')
+FLAG_XOR = 0x01
+# entries are written to a temporary file in their shard, then renamed over the old one
+TMP_SUFFIX = '.tmp'
+
+# xor the payload so cached files aren't browsable as images, costs one extra copy on read
+OBFUSCATE = False
+XOR_KEY = 0x5A
+XOR_TABLE = bytes(i ^ XOR_KEY for i in range(256))
+
+# pixel bytes of decoded and resized images kept in memory
+IMAGE_BUDGET = 64 * 1024 * 1024
+
+
+class CacheIndex:
+    """SQLite index of all entries under one cache root, access times are batched in memory"""
+
+    def __init__(self, root):
+        self.path = os.path.join(root, INDEX)
+        self.lock = threading.Lock()
+        self.pending = {}
+
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                        'domen TEXT NOT NULL, key TEXT NOT NULL, size INTEGER NOT NULL, content_type TEXT, '
+                        'fetched REAL NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (domen, key))')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(entries)')]
+        if 'etag' not in columns:
+            self.db.execute('ALTER TABLE entries ADD COLUMN etag TEXT')
+            self.db.execute('ALTER TABLE entries ADD COLUMN last_modified TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (domen, accessed)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS indexed (domen TEXT PRIMARY KEY)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dead ('
+                        'domen TEXT NOT NULL, key TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (domen, key))')
+        self.db.commit()
+
+    def lookup(self, domen, key):
+        """Returns (size, content_type, fetched, accessed, etag, last_modified) or None"""
+        with self.lock:
+            return self.db.execute('SELECT size, content_type, fetched, accessed, etag, last_modified FROM entries '
+                                   'WHERE domen = ? AND key = ?', (domen, key)).fetchone()
+
+    def touch(self, domen, key):
+        with self.lock:
+            self.pending[(domen, key)] = time.time()
+
+    def add(self, domen, key, size, content_type, fetched=None, etag=None, last_modified=None):
+        if fetched is None:
+            fetched = time.time()
+
+        with self.lock:
+            self.pending.pop((domen, key), None)
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (domen, key, size, content_type, fetched, fetched, etag, last_modified))
+            self.db.commit()
+
+    def add_many(self, rows):
+        """Inserts (domen, key, size, content_type, fetched, accessed) rows"""
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, NULL, NULL)', rows)
+            self.db.commit()
+
+    def set_fetched(self, domen, key, fetched=None):
+        with self.lock:
+            self.db.execute('UPDATE entries SET fetched = ? WHERE domen = ? AND key = ?',
+                            (time.time() if fetched is None else fetched, domen, key))
+            self.db.commit()
+
+    def remove(self, domen, keys):
+        with self.lock:
+            for key in keys:
+                self.pending.pop((domen, key), None)
+            self.db.executemany('DELETE FROM entries WHERE domen = ? AND key = ?',
+                                [(domen, key) for key in keys])
+            self.db.commit()
+
+    def flush(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+
+            rows = [(accessed, domen, key) for (domen, key), accessed in self.pending.items()]
+            self.pending.clear()
+            self.db.executemany('UPDATE entries SET accessed = ? WHERE domen = ? AND key = ?', rows)
+            self.db.commit()
+
+    def total_size(self, domen):
+        with self.lock:
+            return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries WHERE domen = ?',
+                                   (domen,)).fetchone()[0]
+
+    def least_recent(self, domen):
+        """Returns (key, size) of all entries of the provider, least recently used first"""
+        self.flush()
+        with self.lock:
+            return self.db.execute('SELECT key, size FROM entries WHERE domen = ? ORDER BY accessed',
+                                   (domen,)).fetchall()
+
+    def keys(self, domen, prefix=''):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT key FROM entries WHERE domen = ? AND key >= ? '
+                                                      'AND key < ? ORDER BY key',
+                                                      (domen, prefix, prefix + '\uffff'))]
+
+    def stats(self, domen):
+        with self.lock:
+            rows = self.db.execute('SELECT content_type, COUNT(*), SUM(size) FROM entries WHERE domen = ? '
+                                   'GROUP BY content_type', (domen,)).fetchall()
+
+        return {content_type: (count, size) for content_type, count, size in rows}
+
+    def is_indexed(self, domen):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM indexed WHERE domen = ?', (domen,)).fetchone() is not None
+
+    def set_indexed(self, domen):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO indexed VALUES (?)', (domen,))
+            self.db.commit()
+
+    def mark_dead(self, domen, key, ttl):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO dead VALUES (?, ?, ?)', (domen, key, time.time() + ttl))
+            self.db.commit()
+
+    def is_dead(self, domen, key):
+        with self.lock:
+            row = self.db.execute('SELECT expires FROM dead WHERE domen = ? AND key = ?', (domen, key)).fetchone()
+
+        return (row is not None) and (row[0] > time.time())
+
+    def purge_dead(self):
+        with self.lock:
+            self.db.execute('DELETE FROM dead WHERE expires <= ?', (time.time(),))
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
+
+
+class DiskCache:
+    """Size-bounded cache of one provider, entries are sharded into cache/<domen>/ab/cd/<key>"""
+
+    def __init__(self, index, root, domen, budget=None):
+        self.index = index
+        self.path = os.path.join(root, domen)
+        self.partial_path = os.path.join(root, PARTIAL, domen)
+        self.domen = domen
+        self.budget = BUDGETS.get(domen, DEFAULT_BUDGET) if budget is None else budget
+        self.lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # until the directory is indexed (first run after an upgrade) misses fall back to the file system
+        self.indexed = index.is_indexed(domen)
+        self.size = index.total_size(domen)
+
+    def get_path(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:4], key)
+
+    def find(self, key):
+        """Returns the path of the entry, moving it from the old flat layout into its shard if needed"""
+        full_path = self.get_path(key)
+        if os.path.isfile(full_path):
+            return full_path
+
+        flat_path = os.path.join(self.path, key)
+        if not os.path.isfile(flat_path):
+            return None
+
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.replace(flat_path, full_path)
+
+        return full_path
+
+    def lookup(self, key):
+        """Returns the path of the entry if the index knows it"""
+        if self.index.lookup(self.domen, key) is not None:
+            return self.get_path(key)
+
+        if self.indexed:
+            return None
+
+        full_path = self.find(key)
+        if full_path is not None:
+            size = os.path.getsize(full_path)
+            self.index.add(self.domen, key, size, None, os.path.getmtime(full_path))
+            with self.lock:
+                self.size += size
+
+        return full_path
+
+    def contains(self, key):
+        return self.lookup(key) is not None
+
+    def drop(self, key):
+        """Deletes a broken entry"""
+        try:
+            os.remove(self.get_path(key))
+        except FileNotFoundError:
+            pass
+        self.forget(key)
+
+    def forget(self, key):
+        """Drops an entry whose file has disappeared behind our back"""
+        row = self.index.lookup(self.domen, key)
+        if row is None:
+            return
+
+        self.index.remove(self.domen, [key])
+        with self.lock:
+            self.size -= row[0]
+
+    def get(self, key):
+        full_path = self.lookup(key)
+        if full_path is None:
+            return None
+
+        try:
+            f = open(full_path, 'rb')
+        except FileNotFoundError:
+            self.forget(key)
+            return None
+
+        with f:
+            try:
+                flags = read_header(f)
+            except TornEntry:
+                f.close()
+                self.drop(key)
+                return None
+
+            if flags is None:
+                data = self.upgrade(key, f)
+            else:
+                data = f.read()
+                if flags & FLAG_XOR:
+                    data = data.translate(XOR_TABLE)
+
+        self.index.touch(self.domen, key)
+
+        return data
+
+    def open(self, key):
+        """Returns a seekable file with the entry payload (backed by mmap when possible) or None"""
+        full_path = self.lookup(key)
+        if full_path is None:
+            return None
+
+        try:
+            f = open(full_path, 'rb')
+        except FileNotFoundError:
+            self.forget(key)
+            return None
+
+        try:
+            flags = read_header(f)
+        except TornEntry:
+            f.close()
+            self.drop(key)
+            return None
+
+        try:
+            if flags is None:
+                reader = io.BytesIO(self.upgrade(key, f))
+            elif flags & FLAG_XOR:
+                reader = io.BytesIO(f.read().translate(XOR_TABLE))
+            else:
+                reader = PayloadReader(f, HEADER.size)
+        except BaseException:
+            f.close()
+            raise
+
+        if not isinstance(reader, PayloadReader):
+            f.close()
+
+        self.index.touch(self.domen, key)
+
+        return reader
+
+    def put(self, key, data, content_type=None, etag=None, last_modified=None):
+        if (data is None) or (len(data) == 0):
+            return
+
+        full_path = self.get_path(key)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        row = self.index.lookup(self.domen, key)
+        old_size = 0 if row is None else row[0]
+        if content_type is None and row is not None:
+            content_type = row[1]
+
+        flags = FLAG_XOR if OBFUSCATE else 0
+        if flags & FLAG_XOR:
+            data = bytes(data).translate(XOR_TABLE)
+
+        # readers may have the old file mmapped, truncating it under them would crash them
+        fd, tmp_path = tempfile.mkstemp(suffix=TMP_SUFFIX, dir=os.path.dirname(full_path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, flags, 0))
+                f.write(data)
+            os.replace(tmp_path, full_path)
+        except PermissionError:
+            # windows won't replace a file that is open, the entry being read is kept
+            os.remove(tmp_path)
+            return
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        size = HEADER.size + len(data)
+        self.index.add(self.domen, key, size, content_type, etag=etag, last_modified=last_modified)
+
+        with self.lock:
+            self.size += size - old_size
+            over_budget = self.size > self.budget
+
+        if over_budget:
+            evictor.wake()
+
+    def get_partial_path(self, key):
+        return os.path.join(self.partial_path, key)
+
+    def partial_size(self, key):
+        try:
+            return os.path.getsize(self.get_partial_path(key))
+        except OSError:
+            return 0
+
+    def open_partial(self, key, offset):
+        """Opens the partial download for appending, anything after offset is dropped"""
+        os.makedirs(self.partial_path, exist_ok=True)
+        f = open(self.get_partial_path(key), 'ab')
+        f.truncate(offset)
+        return f
+
+    def discard_partial(self, key):
+        for path in (self.get_partial_path(key), self.get_partial_path(key) + VALIDATOR):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get_partial_validator(self, key):
+        """If-Range value for resuming the partial download, None if it is unknown"""
+        try:
+            with open(self.get_partial_path(key) + VALIDATOR, encoding='utf-8') as f:
+                return f.read() or None
+        except OSError:
+            return None
+
+    def set_partial_validator(self, key, validator):
+        path = self.get_partial_path(key) + VALIDATOR
+        if validator is None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+
+        os.makedirs(self.partial_path, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(validator)
+
+    def commit_partial(self, key, content_type=None):
+        """Moves a finished download into the cache, returns its payload"""
+        with open(self.get_partial_path(key), 'rb') as f:
+            data = f.read()
+
+        self.put(key, data, content_type)
+        self.discard_partial(key)
+
+        return data
+
+    def upgrade(self, key, f):
+        """Rewrites an entry stored in the old byte-reversed format, returns its payload"""
+        f.seek(0)
+        data = f.read()[:: -1]
+        f.close()
+        row = self.index.lookup(self.domen, key)
+        self.put(key, data)
+        # rewriting the file doesn't make its content any newer
+        if row is not None:
+            self.index.set_fetched(self.domen, key, row[2])
+
+        return data
+
+    def keys(self, prefix=''):
+        return self.index.keys(self.domen, prefix)
+
+    def is_fresh(self, key):
+        row = self.index.lookup(self.domen, key)
+        # entries indexed from the file system have no content type, their age is unknown
+        if (row is None) or (row[1] is None):
+            return False
+
+        max_age = FRESHNESS.get(row[1])
+        return (max_age is None) or (time.time() - row[2] < max_age)
+
+    def get_validators(self, key):
+        """Returns the conditional request headers for revalidating an entry"""
+        row = self.index.lookup(self.domen, key)
+        headers = {}
+        if row is None:
+            return headers
+
+        if row[4] is not None:
+            headers['If-None-Match'] = row[4]
+        if row[5] is not None:
+            headers['If-Modified-Since'] = row[5]
+
+        return headers
+
+    def revalidated(self, key):
+        """The server answered 304, the entry is fresh again"""
+        self.index.set_fetched(self.domen, key)
+
+    def mark_dead(self, key, ttl=DEAD_TTL):
+        """Remembers that a page ident or image url doesn't exist"""
+        self.index.mark_dead(self.domen, key, ttl)
+
+    def is_dead(self, key):
+        return self.index.is_dead(self.domen, key)
+
+    def stats(self):
+        return self.index.stats(self.domen)
+
+    def build_index(self):
+        """Indexes a directory populated before the index existed"""
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                self.find(entry.name)
+
+        rows = []
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            for name in file_names:
+                try:
+                    if name.endswith(TMP_SUFFIX):
+                        # left by a put that was interrupted
+                        os.remove(os.path.join(dir_path, name))
+                        continue
+                    st = os.stat(os.path.join(dir_path, name))
+                except OSError:
+                    continue
+                rows.append((self.domen, name, st.st_size, None, st.st_mtime, st.st_mtime))
+
+        self.index.add_many(rows)
+        self.index.set_indexed(self.domen)
+
+        with self.lock:
+            self.size = self.index.total_size(self.domen)
+            self.indexed = True
+
+        print(f"cache {self.domen}: indexed {len(rows)} entries")
+
+    def evict(self):
+        if not self.indexed:
+            self.build_index()
+
+        with self.lock:
+            if self.size <= self.budget:
+                return 0
+            excess = self.size - int(self.budget * LOW_WATER)
+
+        removed = []
+        removed_size = 0
+        for key, size in self.index.least_recent(self.domen):
+            if removed_size >= excess:
+                break
+            try:
+                os.remove(self.get_path(key))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            removed.append(key)
+            removed_size += size
+
+        self.index.remove(self.domen, removed)
+
+        with self.lock:
+            self.size -= removed_size
+
+        return len(removed)
+
+
+class PayloadReader(io.RawIOBase):
+    """Read-only file over the memory-mapped payload of a cache entry"""
+
+    def __init__(self, f, offset):
+        super().__init__()
+        self.file = f
+        self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)[offset:]
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self.view) - self.pos)
+        if n <= 0:
+            return 0
+
+        b[: n] = self.view[self.pos: self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+            self.mmap.close()
+            self.file.close()
+        super().close()
+
+
+class Evictor(threading.Thread):
+    """Background thread that flushes the indexes and drops least recently used entries over the budget"""
+
+    def __init__(self):
+        super().__init__(name='cache-evictor', daemon=True)
+        self.caches = []
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        # index: time.monotonic() of its last purge_dead
+        self.purged = {}
+
+    def add(self, disk_cache):
+        with self.lock:
+            self.caches.append(disk_cache)
+            if not self.is_alive():
+                self.start()
+        self.wake()
+
+    def wake(self):
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait(FLUSH_INTERVAL)
+            self.event.clear()
+
+            with self.lock:
+                caches = list(self.caches)
+
+            for disk_cache in caches:
+                try:
+                    disk_cache.index.flush()
+                    self.purge(disk_cache.index)
+                    removed = disk_cache.evict()
+                    if removed > 0:
+                        print(f"cache {disk_cache.domen}: evicted {removed} entries")
+                except BaseException as error:
+                    print(error)
+                    traceback.print_exc()
+
+
+    def purge(self, index):
+        now = time.monotonic()
+        last = self.purged.get(index)
+        if (last is None) or (now - last >= PURGE_INTERVAL):
+            index.purge_dead()
+            self.purged[index] = now
+
+
+class ImageCache:
+    """In-memory LRU of decoded images already resized to the target width"""
+
+    def __init__(self, budget=IMAGE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url, width):
+        with self.lock:
+            img = self.images.get((url, width))
+            if img is None:
+                self.misses += 1
+                return None
+
+            self.images.move_to_end((url, width))
+            self.hits += 1
+            return img
+
+    def put(self, url, width, img):
+        size = get_pixel_size(img)
+        if size > self.budget:
+            return
+
+        with self.lock:
+            old = self.images.pop((url, width), None)
+            if old is not None:
+                self.size -= get_pixel_size(old)
+
+            self.images[(url, width)] = img
+            self.size += size
+
+            while self.size > self.budget:
+                _, evicted = self.images.popitem(last=False)
+                self.size -= get_pixel_size(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.images),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def get_pixel_size(img):
+    w, h = img.size
+    return w * h * len(img.getbands())
+
+
+evictor = Evictor()
+image_cache = ImageCache()
+
+caches = {}
+indexes = {}
+caches_lock = threading.Lock()
+
+
+class TornEntry(Exception):
+    """The file is shorter than a header, what is left of a write that didn't finish"""
+
+
+def read_header(f):
+    """Returns the flags of an entry or None for an entry in the old byte-reversed format"""
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise TornEntry(f.name)
+
+    magic, version, flags, _ = HEADER.unpack(header)
+    if (magic != MAGIC) or (version != VERSION):
+        return None
+
+    return flags
+
+
+def migrate(root):
+    """Indexes every provider directory and rewrites byte-reversed entries in the current format"""
+    count = 0
+    for domen in os.listdir(root):
+        if (domen == PARTIAL) or not os.path.isdir(os.path.join(root, domen)):
+            continue
+
+        disk_cache = get_cache(root, domen)
+        if not disk_cache.indexed:
+            disk_cache.build_index()
+
+        for dir_path, dir_names, file_names in os.walk(disk_cache.path):
+            for name in file_names:
+                if name.endswith(TMP_SUFFIX):
+                    continue
+                with open(os.path.join(dir_path, name), 'rb') as f:
+                    try:
+                        legacy = read_header(f) is None
+                    except TornEntry:
+                        legacy = False
+                        disk_cache.drop(name)
+                    if legacy:
+                        disk_cache.upgrade(name, f)
+                        count += 1
+
+        print(f"{domen}: done")
+
+    print(f"{count} entries rewritten")
+
+
+def get_index(root):
+    with caches_lock:
+        index = indexes.get(root)
+        if index is None:
+            index = CacheIndex(root)
+            indexes[root] = index
+
+    return index
+
+
+def close_indexes():
+    with caches_lock:
+        for index in indexes.values():
+            index.close()
+        indexes.clear()
+        caches.clear()
+
+
+def get_cache(root, domen):
+    index = get_index(root)
+    with caches_lock:
+        disk_cache = caches.get((root, domen))
+        if disk_cache is None:
+            disk_cache = DiskCache(index, root, domen)
+            caches[(root, domen)] = disk_cache
+            evictor.add(disk_cache)
+
+    return disk_cache
+
+
+atexit.register(close_indexes)
+
+
+if __name__ == "__main__":
+    migrate(sys.argv[1] if len(sys.argv) > 1 else 'cache')
@@ -0,0 +1,437 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import CancelledError
+from concurrent.futures.thread import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from fetch import CHUNK_SIZE, HEADERS, TIMEOUT, Partial, Reply, Request, final_page_steps, finish_partial, \
+    get_gallery_key, get_gallery_url, get_range_headers, get_total_size, get_write_offset, send_request, store_page, \
+    stream_to_partial
+from latency import latency_tracker
+from proxy import ProxyPool, get_proxies
+from retry import Backoff, retry_policy
+from scheduler import scheduler
+from sessions import POOL_SIZE, session_pool
+
+# requests in flight on the event loop at a time
+MAX_IN_FLIGHT = 256
+
+# without aiohttp the requests are run blocking on this many threads
+FALLBACK_THREADS = 20
+
+
+class LoadToken:
+    """Generation of one user-visible load: cancelling it aborts its engine requests and queued pool tasks
+
+    Results that arrive afterwards are dropped, see viewer.after_idle.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    def add(self, future):
+        """Ties an engine or executor future to the load, returns it"""
+        with self.lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self.futures.add(future)
+
+        if cancelled:
+            future.cancel()
+        else:
+            future.add_done_callback(self.discard)
+
+        return future
+
+    def discard(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            futures = list(self.futures)
+            self.futures.clear()
+
+        for future in futures:
+            future.cancel()
+
+    def check(self):
+        if self.cancelled:
+            raise CancelledError()
+
+
+class Flight:
+    """One fetch shared by every concurrent caller asking for the same resource"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class Engine:
+    """Runs fetch chains and downloads as coroutines on an event loop in its own thread
+
+    submit() takes a coroutine from any thread and returns a concurrent future, call() waits for it.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, sessions=session_pool, policy=retry_policy,
+                 limiter=scheduler, latency=latency_tracker):
+        self.max_in_flight = max_in_flight
+        self.sessions = sessions
+        self.policy = policy
+        self.limiter = limiter
+        self.latency = latency
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+        self.clients = {}
+        self.executor = None
+        self.connections = {}
+        self.requests = {}
+        self.flights = {}
+        self.coalesced = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.loop = asyncio.new_event_loop()
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+            if aiohttp is None:
+                self.executor = ThreadPoolExecutor(max_workers=FALLBACK_THREADS)
+
+            self.thread = threading.Thread(target=self.loop.run_forever, name='fetch-engine', daemon=True)
+            self.thread.start()
+
+    def submit(self, coro, callback=None):
+        """Schedules the coroutine, the callback gets the future and runs on the loop thread"""
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        return future
+
+    def call(self, coro, token=None):
+        """Waits for the coroutine, raises CancelledError when the token is cancelled meanwhile"""
+        future = self.submit(coro)
+        if token is not None:
+            token.add(future)
+
+        return future.result()
+
+    def get_client(self, proxy):
+        client = self.clients.get(proxy)
+        if client is None:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self.on_request_start)
+            trace_config.on_connection_create_end.append(self.on_connection_create_end)
+
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=POOL_SIZE)
+            client = aiohttp.ClientSession(connector=connector, headers=HEADERS, trace_configs=[trace_config],
+                                           timeout=aiohttp.ClientTimeout(sock_connect=TIMEOUT[0],
+                                                                         sock_read=TIMEOUT[1]))
+            self.clients[proxy] = client
+
+        return client
+
+    async def on_request_start(self, client, context, params):
+        context.host = params.url.host
+        self.requests[context.host] = self.requests.get(context.host, 0) + 1
+
+    async def on_connection_create_end(self, client, context, params):
+        host = getattr(context, 'host', None)
+        self.connections[host] = self.connections.get(host, 0) + 1
+
+    async def request(self, request, proxies=None):
+        """Sends the request, retrying its stage on timeouts, connection errors and 5xx responses"""
+        return await self.policy.call_async(request.stage, partial(self.hedge, request, proxies))
+
+    async def hedge(self, request, proxies):
+        """Sends a second copy of a slow request (see latency.HEDGE) and returns whichever answers first"""
+        host = urlparse(request.url).netloc
+        delay = self.latency.get_hedge_delay(host, request)
+        if delay is None:
+            return await self.through(proxies, partial(self.send, request))
+
+        # the copies don't record their latency, the request does, from when its first copy was sent
+        starts = []
+        send = partial(self.through, proxies, partial(self.send, request, starts=starts))
+        first = self.loop.create_task(send())
+        tasks = [first]
+        # a cancelled caller, or the copy that lost, must not leave a request running
+        try:
+            done, pending = await asyncio.wait({first}, timeout=delay)
+            if len(done) > 0:
+                return self.record(host, request, starts, first.result())
+
+            # through another pooled connection, or another proxy since the first one counts as busy
+            second = self.loop.create_task(send())
+            tasks.append(second)
+            pending = {first, second}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latency.count_hedge(request.stage, task is second)
+                        return self.record(host, request, starts, task.result())
+
+                if len(pending) == 0:
+                    self.latency.count_hedge(request.stage, False)
+                    return self.record(host, request, starts, first.result())
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def record(self, host, request, starts, response):
+        if (response.status_code < 500) and (len(starts) > 0):
+            self.latency.add(host, request.stage, time.monotonic() - starts[0])
+        return response
+
+    async def through(self, proxies, send):
+        """Calls send(proxies), with the best proxy of a ProxyPool which is told how the request went"""
+        if not isinstance(proxies, ProxyPool):
+            return await send(proxies)
+
+        address = proxies.choose()
+        if address is None:
+            return await send(None)
+
+        try:
+            result = await send(get_proxies(address))
+        except asyncio.CancelledError:
+            proxies.release(address)
+            raise
+        except BaseException:
+            proxies.report(address, None)
+            raise
+
+        proxies.report(address, None if result.status_code >= 500 else result.latency)
+        return result
+
+    async def send(self, request, proxies=None, starts=None):
+        """Sends the request once, starts collects the send times of hedged copies, which don't record latency"""
+        proxy = None if proxies is None else proxies.get('http')
+        host = urlparse(request.url).netloc
+        timeout = self.latency.get_timeout(host, request.stage)
+        async with self.limiter.slot(request.url, proxy), self.semaphore:
+            start = time.monotonic()
+            if starts is not None:
+                starts.append(start)
+            if aiohttp is None:
+                http_session = self.sessions.get(request.url, proxies)
+                response = await self.loop.run_in_executor(self.executor,
+                                                           partial(send_request, http_session, request, proxies,
+                                                                   timeout))
+            else:
+                client = self.get_client(proxy)
+                async with client.request(request.method, request.url, headers=request.headers,
+                                          data=request.data, proxy=proxy,
+                                          timeout=aiohttp.ClientTimeout(sock_connect=timeout[0],
+                                                                        sock_read=timeout[1])) as reply:
+                    if request.reader is None:
+                        content = await reply.read()
+                    else:
+                        content = await self.read_until(reply, request.reader())
+                    response = Reply(reply.status, content, reply.headers)
+
+            # seconds from getting the slots to the response, the queue wait isn't the proxy's or the host's
+            response.latency = time.monotonic() - start
+            if (starts is None) and (response.status_code < 500):
+                self.latency.add(host, request.stage, response.latency)
+
+        await self.limiter.consume(len(response.content))
+        return response
+
+    @staticmethod
+    async def read_until(reply, reader):
+        """Feeds the body to the reader as it arrives, closes the connection once the reader is done"""
+        async for chunk in reply.content.iter_any():
+            if reader.feed(chunk):
+                reply.close()
+                break
+
+        return reader.get_content()
+
+    async def run_steps(self, steps, proxies):
+        """Drives a fetch chain (see fetch.final_page_steps) without blocking a thread"""
+        try:
+            request = next(steps)
+            while True:
+                if isinstance(request, Backoff):
+                    await self.policy.backoff_async(request)
+                    request = steps.send(None)
+                    continue
+
+                response = await self.request(request, proxies)
+                request = steps.send(response)
+        except StopIteration as stop:
+            return stop.value
+
+    async def get_final_page(self, provider, ident, input_url, proxies, disk_cache):
+        return await self.run_steps(final_page_steps(provider, ident, input_url, disk_cache), proxies)
+
+    async def single_flight(self, kind, key, factory):
+        """Awaits factory() once for all concurrent callers with the same key, they share its result
+
+        The fetch is cancelled only when every caller waiting for it is.
+        """
+        flight = self.flights.get((kind, key))
+        if flight is None:
+            flight = Flight(self.loop.create_task(factory()))
+            self.flights[(kind, key)] = flight
+            flight.task.add_done_callback(partial(self.land, (kind, key), flight))
+        else:
+            self.coalesced[kind] = self.coalesced.get(kind, 0) + 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1:
+                # later callers start a fetch of their own instead of joining the dying one
+                self.land((kind, key), flight, flight.task)
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def land(self, key, flight, task):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    async def resolve_page(self, provider, ident, input_url, proxies, disk_cache):
+        """Runs the GET/redirect/POST chain and caches the page model, returns it or None"""
+        return await self.single_flight('page', (provider.get_domen(), ident),
+                                        partial(self.resolve_page_once, provider, ident, input_url, proxies,
+                                                disk_cache))
+
+    async def resolve_page_once(self, provider, ident, input_url, proxies, disk_cache):
+        html = await self.get_final_page(provider, ident, input_url, proxies, disk_cache)
+        return store_page(provider, ident, html, disk_cache)
+
+    async def download_image(self, url, proxies=None, stage='image'):
+        return await self.single_flight('image', url, partial(self.download_image_once, url, proxies, stage))
+
+    async def download_image_once(self, url, proxies, stage):
+        response = await self.request(Request('GET', url, stage=stage), proxies)
+        if response.status_code == 404:
+            return None
+
+        return response.content
+
+    async def download_gallery_page(self, provider, gallery, page, disk_cache, proxies=None):
+        """Fetches a gallery page into the cache, revalidating the cached copy, returns the response
+
+        The gallery window and the prefetcher share one request for the same page.
+        """
+        key = get_gallery_key(gallery, page)
+        return await self.single_flight('gallery', (provider.get_domen(), key),
+                                        partial(self.download_gallery_page_once, provider, gallery, page, disk_cache,
+                                                proxies))
+
+    async def download_gallery_page_once(self, provider, gallery, page, disk_cache, proxies):
+        key = get_gallery_key(gallery, page)
+        response = await self.request(Request('GET', get_gallery_url(provider, gallery, page),
+                                              disk_cache.get_validators(key), stage='gallery'), proxies)
+        if response.status_code == 304:
+            disk_cache.revalidated(key)
+        elif response.status_code == 200:
+            disk_cache.put(key, response.content, 'gallery',
+                           response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+        return response
+
+    async def download_original(self, url, disk_cache, key, proxies=None, progress=None):
+        """Streams an original image into the cache, progress(done, total) is called on the loop thread"""
+        # two streams into the same partial file would corrupt it
+        return await self.single_flight('original', url,
+                                        partial(self.download_original_once, url, disk_cache, key, proxies, progress))
+
+    async def download_original_once(self, url, disk_cache, key, proxies, progress):
+        result = await self.policy.call_async('original', partial(self.through, proxies,
+                                                                  lambda p: self.stream(url, disk_cache, key, p,
+                                                                                        progress)))
+        return finish_partial(result, disk_cache, key)
+
+    async def stream(self, url, disk_cache, key, proxies=None, progress=None):
+        proxy = None if proxies is None else proxies.get('http')
+        async with self.limiter.slot(url, proxy), self.semaphore:
+            if aiohttp is None:
+                http_session = self.sessions.get(url, proxies)
+                result = await self.loop.run_in_executor(self.executor,
+                                                         partial(stream_to_partial, http_session, url, disk_cache,
+                                                                 key, proxies, progress))
+                await self.limiter.consume(result.size)
+                return result
+
+            offset, headers = get_range_headers(disk_cache, key)
+            client = self.get_client(proxy)
+            start = time.monotonic()
+            async with client.get(url, headers=headers, proxy=proxy) as response:
+                latency = time.monotonic() - start
+                if response.status not in (200, 206):
+                    return Partial(response.status, offset, latency=latency)
+
+                total = get_total_size(response.status, response.headers, offset)
+                offset = get_write_offset(url, response.status, response.headers, disk_cache, key, offset)
+
+                with disk_cache.open_partial(key, offset) as f:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        f.write(chunk)
+                        offset += len(chunk)
+                        if progress is not None:
+                            progress(offset, total)
+                        await self.limiter.consume(len(chunk))
+
+        if (total is not None) and (offset < total):
+            raise ConnectionError(f'{url}: {offset} of {total} bytes')
+
+        return Partial(response.status, offset, total, latency)
+
+    def stats(self):
+        """Returns {host: (connections opened, requests sent)}"""
+        if aiohttp is None:
+            return self.sessions.stats()
+
+        return {host: (self.connections.get(host, 0), count) for host, count in self.requests.items()}
+
+    def print_stats(self):
+        for host, (connections, count) in sorted(self.stats().items(), key=lambda item: str(item[0])):
+            print(f"{host}: {count} requests over {connections} connections")
+        for kind, count in sorted(self.coalesced.items()):
+            print(f"{kind}: {count} requests coalesced")
+        self.limiter.print_stats()
+        self.latency.print_stats()
+        self.policy.print_stats()
+
+    async def close_clients(self):
+        for client in self.clients.values():
+            await client.close()
+        self.clients.clear()
+
+    def close(self):
+        if self.thread is None:
+            return
+
+        self.call(self.close_clients())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+engine = Engine()
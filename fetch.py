@@ -0,0 +1,336 @@
+import os
+import time
+from functools import partial
+from urllib.parse import urlparse
+
+from page import PageModel, is_page_model
+from providers import FILE_NOT_FOUND
+from retry import PARSE_ERROR, SERVER_ERROR, Backoff, StageError
+
+DEBUG = False
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:68.0) Gecko/20100101 Firefox/68.0'
+
+HEADERS = {
+    'User-agent': USER_AGENT,
+}
+
+TIMEOUT = (3.05, 9.05)
+# originals are streamed to a partial file in chunks of this size
+CHUNK_SIZE = 64 * 1024
+GALLERY_PAGE_SIZE = 15
+
+# read the pages of the fetch chain only until everything it uses has arrived, see page.PageReader
+STREAM_PAGES = True
+# requests blocks until a whole chunk arrived, pages are fed to their reader in smaller ones
+PAGE_CHUNK_SIZE = 8 * 1024
+
+
+class DeadLinkError(Exception):
+    pass
+
+
+class Request:
+    """One HTTP request of a fetch chain, see final_page_steps"""
+
+    def __init__(self, method, url, headers=None, data=None, stage='request', reader=None):
+        self.method = method
+        # redirect urls come base64 decoded as bytes
+        self.url = url.decode('utf-8') if isinstance(url, bytes) else url
+        self.headers = headers
+        self.data = data
+        # failures are retried per stage, see retry.RetryPolicy
+        self.stage = stage
+        # makes a page.PageReader, the response body is then read only until the reader is done
+        self.reader = reader if STREAM_PAGES else None
+
+
+class Reply:
+    """Response of a streamed or aiohttp request with the attributes the fetch chains use from requests.Response"""
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+
+def check_status(response, stage):
+    """A 5xx that outlasted the retries of its request ends the chain, parsing it would only retry it again"""
+    if response.status_code >= 500:
+        raise StageError(stage, SERVER_ERROR, f'status {response.status_code}')
+
+
+def final_page_steps(provider, ident, input_url, disk_cache):
+    """GET/redirect/POST chain as a generator: yields Requests, is sent their responses, returns the page
+
+    A response that doesn't parse makes the chain yield a Backoff and repeat only that stage.
+    """
+    attempt = 0
+    while True:
+        response = yield Request('GET', input_url, stage='page', reader=partial(provider.get_reader, 'page'))
+        check_status(response, 'page')
+        if response.status_code == 404:
+            print("input_url response.status_code == 404")
+            disk_cache.mark_dead(ident)
+            raise DeadLinkError(input_url)
+
+        html = response.content.decode('utf-8')
+
+        if DEBUG:
+            with open('1.html', 'w') as f:
+                f.write(html)
+
+        # sometimes this functions fails (i don't want to tamper with this)
+        redirect_url = provider.get_redirect_url(html)
+        if (redirect_url is None) or (len(redirect_url) > 0):
+            break
+
+        print("(redirect_url is None) or (len(redirect_url) == 0)")
+        yield Backoff('page', attempt)
+        attempt += 1
+
+    attempt = 0
+    while True:
+        if redirect_url is not None:
+            response = yield Request('GET', redirect_url, {'Referer': input_url}, stage='redirect',
+                                     reader=partial(provider.get_reader, 'redirect'))
+            check_status(response, 'redirect')
+            if response.status_code == 404:
+                print("redirect_url response.status_code == 404")
+                disk_cache.mark_dead(ident)
+                raise DeadLinkError(input_url)
+
+            html = response.content.decode('utf-8')
+
+            if DEBUG:
+                with open('2.html', 'w') as f:
+                    f.write(html)
+
+        pos = html.find(FILE_NOT_FOUND)
+        if pos >= 0:
+            print("File Not Found: " + input_url)
+            disk_cache.mark_dead(ident)
+            raise DeadLinkError(input_url)
+
+        param = provider.get_post_param(html)
+        if len(param) > 0:
+            break
+
+        print("len(param) == 0")
+        if redirect_url is None:
+            raise StageError('page', PARSE_ERROR, 'no post param')
+
+        yield Backoff('redirect', attempt)
+        attempt += 1
+
+    post_fields = {
+        'op': 'view',
+        'id': ident,
+        'pre': 1,
+        param: 1
+    }
+    response = yield Request('POST', redirect_url, {'Referer': input_url}, post_fields, stage='post',
+                             reader=partial(provider.get_reader, 'post'))
+    check_status(response, 'post')
+    if response.status_code == 404:
+        print("POST: redirect_url response.status_code == 404")
+        disk_cache.mark_dead(ident)
+        raise DeadLinkError(input_url)
+
+    html = response.content
+
+    if DEBUG:
+        with open('3.html', 'wb') as f:
+            f.write(html)
+
+    return html
+
+
+def send_request(http_session, request, proxies=None, timeout=TIMEOUT):
+    """Sends the request, with a reader the body is streamed and the connection closed once the reader is done"""
+    if request.reader is None:
+        return http_session.request(request.method, request.url, headers=request.headers, data=request.data,
+                                    proxies=proxies, timeout=timeout)
+
+    response = http_session.request(request.method, request.url, headers=request.headers, data=request.data,
+                                    proxies=proxies, timeout=timeout, stream=True)
+    reader = request.reader()
+    try:
+        for chunk in response.iter_content(PAGE_CHUNK_SIZE):
+            if reader.feed(chunk):
+                break
+    finally:
+        response.close()
+
+    return Reply(response.status_code, reader.get_content(), response.headers)
+
+
+def get_page_model(disk_cache, provider, ident):
+    data = disk_cache.get(ident)
+    if (data is None) or (len(data) == 0):
+        return None
+
+    if is_page_model(data):
+        return PageModel.from_bytes(data)
+
+    # raw page cached by an older version
+    model = PageModel.from_html(data.decode('utf-8'), provider)
+    disk_cache.put(ident, model.to_bytes(), 'page')
+    return model
+
+
+def store_page(provider, ident, html, disk_cache):
+    if (html is None) or (len(html) == 0):
+        return None
+
+    model = PageModel.from_html(html.decode('utf-8'), provider)
+    if len(model.thumb_url) > 0:
+        disk_cache.put(ident, model.to_bytes(), 'page')
+
+    return model
+
+
+def get_range_headers(disk_cache, key):
+    """Returns (offset, headers) asking for the rest of the partial download of key, if it can be resumed"""
+    offset = disk_cache.partial_size(key)
+    validator = disk_cache.get_partial_validator(key)
+    if (offset > 0) and (validator is None):
+        # nothing tells whether the remote file is still the one the partial was started from
+        disk_cache.discard_partial(key)
+        offset = 0
+
+    if offset == 0:
+        return 0, None
+
+    # a server whose file changed answers 200 with all of it
+    return offset, {'Range': f'bytes={offset}-', 'If-Range': validator}
+
+
+def get_validator(headers):
+    """A strong ETag, else Last-Modified, None if the response has neither (If-Range can't use weak ETags)"""
+    etag = headers.get('ETag')
+    if (etag is not None) and not etag.startswith('W/'):
+        return etag
+
+    return headers.get('Last-Modified')
+
+
+def get_range_start(headers):
+    """First byte of a 206 from Content-Range 'bytes START-END/TOTAL', None if it doesn't parse"""
+    content_range = headers.get('Content-Range', '')
+    if not content_range.startswith('bytes '):
+        return None
+
+    start = content_range[len('bytes '):].split('-', 1)[0].strip()
+    return int(start) if start.isdigit() else None
+
+
+def get_write_offset(url, status_code, headers, disk_cache, key, offset):
+    """Where the body of a 200 or 206 goes in the partial file"""
+    if status_code == 206:
+        start = get_range_start(headers)
+        if start != offset:
+            # appending would leave a gap or repeat bytes, the next attempt starts over
+            disk_cache.discard_partial(key)
+            raise ConnectionError(f'{url}: range starts at {start}, expected {offset}')
+        return offset
+
+    # the server ignored Range or the file changed since the partial was started
+    disk_cache.set_partial_validator(key, get_validator(headers))
+    return 0
+
+
+def get_total_size(status_code, headers, offset):
+    """Full size of the file from Content-Range (206) or Content-Length (200), None if unknown"""
+    if status_code == 206:
+        content_range = headers.get('Content-Range', '')
+        slash_pos = content_range.rfind('/')
+        total = content_range[slash_pos + 1:]
+        return int(total) if total.isdigit() else None
+
+    length = headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else None
+
+
+class Partial:
+    """Status of one attempt of a streamed download, with the attributes RetryPolicy checks"""
+
+    def __init__(self, status_code, size=0, total=None, latency=None):
+        self.status_code = status_code
+        self.size = size
+        self.total = total
+        # seconds until the response headers arrived, what ProxyPool scores proxies by
+        self.latency = latency
+
+
+def stream_to_partial(http_session, url, disk_cache, key, proxies=None, progress=None):
+    """Downloads url into the partial file of key, resuming it when the server honours Range"""
+    offset, headers = get_range_headers(disk_cache, key)
+    start = time.monotonic()
+    with http_session.get(url, headers=headers, proxies=proxies, timeout=TIMEOUT, stream=True) as response:
+        latency = time.monotonic() - start
+        if response.status_code not in (200, 206):
+            return Partial(response.status_code, offset, latency=latency)
+
+        total = get_total_size(response.status_code, response.headers, offset)
+        offset = get_write_offset(url, response.status_code, response.headers, disk_cache, key, offset)
+
+        with disk_cache.open_partial(key, offset) as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                offset += len(chunk)
+                if progress is not None:
+                    progress(offset, total)
+
+    if (total is not None) and (offset < total):
+        # the connection dropped, the next attempt resumes from here
+        raise ConnectionError(f'{url}: {offset} of {total} bytes')
+
+    return Partial(response.status_code, offset, total, latency)
+
+
+def finish_partial(result, disk_cache, key):
+    if result.status_code == 416:
+        # the partial file doesn't match the remote one anymore
+        disk_cache.discard_partial(key)
+        raise StageError('original', PARSE_ERROR, 'range not satisfiable')
+
+    if result.status_code == 404:
+        disk_cache.discard_partial(key)
+        return None
+
+    if result.status_code not in (200, 206):
+        raise StageError('original', SERVER_ERROR, f'status {result.status_code}')
+
+    return disk_cache.commit_partial(key, 'image')
+
+
+def get_filename(url):
+    res = urlparse(url)
+    fname = os.path.basename(res.path)
+
+    if fname.endswith(".html"):
+        return fname[:-5]
+
+    return fname
+
+
+def get_thumb_key(img_url):
+    filename = get_filename(img_url)
+    dot_pos = filename.rfind('.')
+    return filename[: dot_pos]
+
+
+def get_original_key(image_url, ident):
+    fname = get_filename(image_url)
+    dot_pos = fname.rfind('.')
+    return fname[: dot_pos] + '_' + ident
+
+
+def get_gallery_url(provider, gallery, page):
+    return f'https://{provider.get_host()}/?fld_hash={gallery}&' \
+           f'op=gallery&per_page={GALLERY_PAGE_SIZE}&page={page}'
+
+
+def get_gallery_key(gallery, page):
+    return f'{gallery}_{page:05}'
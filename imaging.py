@@ -0,0 +1,42 @@
+from PIL import Image
+
+# name: (resampling filter, reducing gap), see open_scaled
+RESAMPLE_MODES = {
+    # JPEGs decoded at the DCT scale closest to the target, then a bilinear resize
+    'fast': (Image.BILINEAR, 1.0),
+    # bicubic like a plain resize, from a decode at least twice the target
+    'balanced': (Image.BICUBIC, 2.0),
+    # lanczos from a decode at least three times the target, close to a full decode
+    'quality': (Image.LANCZOS, 3.0),
+}
+RESAMPLE = 'balanced'
+
+
+def get_height(size, width):
+    w, h = size
+    return max(1, int(h * width / w))
+
+
+def scale(img, width, mode=None):
+    """Resizes an already decoded image to width pixels keeping its aspect"""
+    resample, reducing_gap = RESAMPLE_MODES[mode or RESAMPLE]
+    height = get_height(img.size, width)
+    if width >= img.width:
+        return img.resize((width, height), resample)
+
+    return img.resize((width, height), resample, reducing_gap=reducing_gap)
+
+
+def open_scaled(fp, width, mode=None):
+    """Decodes the image straight to width pixels, returns it with the size of the original
+
+    A JPEG is decoded by its DCT at 1/2, 1/4 or 1/8 of its size, the smallest of them still reducing gap
+    times the target, so the full resolution is never decoded. Other formats are decoded fully.
+    """
+    img = Image.open(fp)
+    size = img.size
+    _, reducing_gap = RESAMPLE_MODES[mode or RESAMPLE]
+    if width < size[0]:
+        img.draft(None, (int(width * reducing_gap), int(get_height(size, width) * reducing_gap)))
+
+    return scale(img, width, mode), size
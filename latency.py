@@ -0,0 +1,84 @@
+import threading
+from collections import deque
+
+from fetch import TIMEOUT
+
+# latencies remembered per host and content class (the stage of the request)
+WINDOW = 200
+# below this many samples the fixed TIMEOUT is used
+MIN_SAMPLES = 20
+# read timeout = p99 * TIMEOUT_FACTOR, kept within these bounds
+TIMEOUT_FACTOR = 3
+MIN_READ_TIMEOUT = 2.0
+MAX_READ_TIMEOUT = 30.0
+
+# send a second identical request when the first is slower than the p95 of its class
+HEDGE = True
+# only idempotent GETs of small resources are hedged
+HEDGE_STAGES = {'thumb', 'gallery'}
+
+
+class LatencyTracker:
+    """Rolling request latencies per host and content class, the source of adaptive timeouts and hedge delays"""
+
+    def __init__(self, window=WINDOW, min_samples=MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+        self.hedges = {}
+        self.lock = threading.Lock()
+
+    def add(self, host, stage, seconds):
+        with self.lock:
+            samples = self.samples.get((host, stage))
+            if samples is None:
+                samples = deque(maxlen=self.window)
+                self.samples[(host, stage)] = samples
+            samples.append(seconds)
+
+    def get_percentile(self, host, stage, q):
+        """Returns the q-th percentile (0..100) of the latency or None while there are too few samples"""
+        with self.lock:
+            samples = self.samples.get((host, stage))
+            if (samples is None) or (len(samples) < self.min_samples):
+                return None
+            ordered = sorted(samples)
+
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+    def get_timeout(self, host, stage):
+        """(connect, read) timeouts for the next request"""
+        p99 = self.get_percentile(host, stage, 99)
+        if p99 is None:
+            return TIMEOUT
+
+        return TIMEOUT[0], min(MAX_READ_TIMEOUT, max(MIN_READ_TIMEOUT, p99 * TIMEOUT_FACTOR))
+
+    def get_hedge_delay(self, host, request):
+        if not HEDGE or (request.method != 'GET') or (request.stage not in HEDGE_STAGES):
+            return None
+
+        return self.get_percentile(host, request.stage, 95)
+
+    def count_hedge(self, stage, won):
+        with self.lock:
+            sent, wins = self.hedges.get(stage, (0, 0))
+            self.hedges[stage] = (sent + 1, wins + (1 if won else 0))
+
+    def print_stats(self):
+        with self.lock:
+            keys = sorted(self.samples)
+            hedges = dict(self.hedges)
+
+        for host, stage in keys:
+            p50 = self.get_percentile(host, stage, 50)
+            p95 = self.get_percentile(host, stage, 95)
+            if p50 is None:
+                continue
+            print(f"{host} {stage}: p50 {p50:.3f}s, p95 {p95:.3f}s, read timeout {self.get_timeout(host, stage)[1]:.1f}s")
+
+        for stage, (sent, wins) in sorted(hedges.items()):
+            print(f"{stage}: {sent} hedged requests, {wins} answered first")
+
+
+latency_tracker = LatencyTracker()
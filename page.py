@@ -0,0 +1,269 @@
+import json
+import math
+import re
+import zlib
+
+# serialized models start with this so they can't be mistaken for a cached raw page
+MODEL_MAGIC = b'\x00PM1'
+
+# keep the raw page in the model, only useful for debugging the parsers
+KEEP_HTML = False
+
+# compiled search() patterns, the set of patterns is small and fixed
+PATTERNS = {}
+
+# every obfuscated _0x... = "..." or '...' assignment of a provider page
+VARIABLE = re.compile(r'''(_0x\w+)=(["'])(.*?)\2''', re.DOTALL)
+
+# landmarks of the final page in document order, scan_page finds everything between them
+FINAL_PAGE_SECTIONS = (('[IMG]', '[/IMG]'),
+                       ('">More from gallery</a>',),
+                       ('<td align="left"', '<table>', '</table>'),
+                       ('<td align="right"', '<table>', '</table>'))
+PICVIEW_SECTION = ('>Next', '" class="picview"')
+
+LINK = re.compile('<td>.*?href="(.*?)".*?src="(.*?)".*?</td>', re.MULTILINE | re.DOTALL)
+GALLERY_LINK = re.compile('<TD>.*?href="(.*?)".*?src="(.*?)".*?</TD>', re.MULTILINE | re.DOTALL)
+
+
+class PageModel:
+    """Everything the viewer needs from an image page"""
+
+    __slots__ = ('thumb_url', 'image_url', 'gallery_url', 'prev_url', 'next_url',
+                 'author_links', 'gallery_links', 'html')
+
+    def __init__(self, thumb_url='', image_url='', gallery_url='', prev_url='', next_url='',
+                 author_links=(), gallery_links=(), html=None):
+        self.thumb_url = thumb_url
+        self.image_url = image_url
+        self.gallery_url = gallery_url
+        self.prev_url = prev_url
+        self.next_url = next_url
+        self.author_links = list(author_links)
+        self.gallery_links = list(gallery_links)
+        self.html = html
+
+    @staticmethod
+    def from_html(html, provider):
+        model, picview_url = scan_page(html)
+        model.image_url = provider.find_image_url(html, picview_url)
+        if len(model.image_url) == 0:
+            model.image_url = provider.get_image_url(html)
+
+        if KEEP_HTML:
+            model.html = html
+
+        return model
+
+    @staticmethod
+    def from_bytes(data):
+        fields = json.loads(zlib.decompress(data[len(MODEL_MAGIC):]))
+        fields['author_links'] = [tuple(link) for link in fields['author_links']]
+        fields['gallery_links'] = [tuple(link) for link in fields['gallery_links']]
+        return PageModel(**fields)
+
+    def to_bytes(self):
+        fields = {name: getattr(self, name) for name in PageModel.__slots__}
+        if fields['html'] is None:
+            del fields['html']
+
+        return MODEL_MAGIC + zlib.compress(json.dumps(fields, separators=(',', ':')).encode('utf-8'))
+
+
+def is_page_model(data):
+    return data[: len(MODEL_MAGIC)] == MODEL_MAGIC
+
+
+def search(pattern, string):
+    compiled = PATTERNS.get(pattern)
+    if compiled is None:
+        compiled = re.compile(pattern, re.MULTILINE | re.DOTALL)
+        PATTERNS[pattern] = compiled
+
+    found = compiled.search(string)
+    if (found is None) or (found.group(0) is None):
+        return ""
+
+    return found.group(1)
+
+
+class Variables(dict):
+    """Values of the obfuscated variables of a page, missing ones read as '' like a failed search()"""
+
+    def __missing__(self, key):
+        return ''
+
+
+def get_variables(html):
+    """Collects every _0x... assignment of the page in one scan, the first assignment of a name wins"""
+    variables = Variables()
+    for found in VARIABLE.finditer(html):
+        if found.group(1) not in variables:
+            variables[found.group(1)] = found.group(3)
+
+    return variables
+
+
+class PageReader:
+    """Incremental extractor fed the chunks of a page being downloaded, done once every required piece arrived
+
+    sections: sequences of markers that must appear in this order, e.g. ('<td align="left"', '<table>', '</table>')
+    variables: names of _0x... assignments whose quoted value must be complete
+    stop: markers that are enough on their own, e.g. 'File Not Found'
+    """
+
+    def __init__(self, sections=(), variables=(), stop=()):
+        self.data = bytearray()
+        # [markers left, where to search for the next one]
+        self.sections = [[[marker.encode('utf-8') for marker in section], 0] for section in sections]
+        self.variables = [[name.encode('utf-8') + b'=', 0] for name in variables]
+        self.stop = [[[marker.encode('utf-8')], 0] for marker in stop]
+        # the page up to the end of the last required piece
+        self.end = 0
+        self.done = False
+
+    def feed(self, chunk):
+        """Adds the next chunk, returns True once the rest of the page isn't needed"""
+        self.data += chunk
+        for stop in self.stop:
+            if self.find_section(stop):
+                self.done = True
+                return True
+
+        self.sections = [section for section in self.sections if not self.find_section(section)]
+        self.variables = [variable for variable in self.variables if not self.find_variable(variable)]
+        self.done = (len(self.sections) == 0) and (len(self.variables) == 0)
+        return self.done
+
+    def find_section(self, section):
+        markers = section[0]
+        while len(markers) > 0:
+            pos = self.data.find(markers[0], section[1])
+            if pos < 0:
+                section[1] = max(section[1], len(self.data) - len(markers[0]) + 1)
+                return False
+            section[1] = pos + len(markers.pop(0))
+
+        self.end = max(self.end, section[1])
+        return True
+
+    def find_variable(self, variable):
+        assignment, start = variable
+        while True:
+            pos = self.data.find(assignment, start)
+            if pos < 0:
+                variable[1] = max(start, len(self.data) - len(assignment) + 1)
+                return False
+
+            quote = pos + len(assignment)
+            if quote >= len(self.data):
+                variable[1] = pos
+                return False
+            if self.data[quote] not in b'"\'':
+                start = quote
+                continue
+
+            close = self.data.find(self.data[quote:quote + 1], quote + 1)
+            if close < 0:
+                variable[1] = pos
+                return False
+
+            self.end = max(self.end, close + 1)
+            return True
+
+    def get_content(self):
+        """The page read so far, cut after the last required piece once done so it never ends mid character"""
+        return bytes(self.data[:self.end] if self.done else self.data)
+
+
+def get_quoted_before(html, end, attribute='href="'):
+    """Value of the attribute whose closing quote is at end, '' when end doesn't close such a value"""
+    if end < 0:
+        return ''
+    begin = html.rfind('"', 0, end)
+    if (begin < 0) or not html.startswith(attribute, begin + 1 - len(attribute)):
+        return ''
+    return html[begin + 1:end]
+
+
+def get_panel(html, align):
+    """Table of the side panel, the links of get_links() without the search() of the whole page"""
+    cell = html.find(f'<td align="{align}"')
+    if cell < 0:
+        return []
+    begin = html.find('<table>', cell)
+    end = html.find('</table>', begin)
+    if (begin < 0) or (end < 0):
+        return []
+    return get_links(html[begin + len('<table>'):end])
+
+
+def scan_page(html):
+    """Builds the page model walking the page once from landmark to landmark
+
+    Every landmark is located with str.find, the regular expressions only run on the panel tables.
+    Returns the model without image_url and the picview image url for provider.find_image_url.
+    """
+    thumb_url = gallery_url = prev_url = next_url = picview_url = ''
+
+    begin = html.find('[IMG]')
+    if begin >= 0:
+        end = html.find('[/IMG]', begin)
+        if end >= 0:
+            thumb_url = html[begin + len('[IMG]'):end]
+
+    prev_label = html.find('>< Previous')
+    if prev_label >= 0:
+        prev_url = get_quoted_before(html, html.rfind('"><span', 0, prev_label))
+        next_label = html.find('>Next', prev_label)
+        if next_label >= 0:
+            next_url = get_quoted_before(html, html.rfind('"><span', prev_label, next_label))
+            picview = html.find('" class="picview"', next_label)
+            picview_url = get_quoted_before(html, picview, '<img src="')
+
+    gallery_url = get_quoted_before(html, html.find('">More from gallery</a>'))
+
+    model = PageModel(thumb_url=thumb_url, gallery_url=gallery_url, prev_url=prev_url, next_url=next_url,
+                      author_links=get_panel(html, 'left'), gallery_links=get_panel(html, 'right'))
+    return model, picview_url
+
+
+def get_next_url(html):
+    return search('< Previous.+?<a style=.+?href="(.*?)"><span.*?>Next', html)
+
+
+def get_prev_url(html):
+    return search('<a style=.+?href="(.*?)"><span.*?>< Previous', html)
+
+
+def get_more_from_author(html):
+    tab = search('<td align="left".*?<table>(.*?)</table>.*?</td>', html)
+    return tab
+
+
+def get_more_from_gallery(html):
+    tab = search('<td align="right".*?<table>(.*?)</table>.*?</td>', html)
+    return tab
+
+
+def get_thumb(html):
+    return search(r'\[IMG\](.*?)\[/IMG\]', html)
+
+
+def get_links(tab):
+    """Returns (page url, thumbnail url) of every cell of a side panel table"""
+    return [(m.group(1), m.group(2)) for m in LINK.finditer(tab)]
+
+
+def get_page_count(html, page_size):
+    total = search(r'<small>\(([0-9]+) total\)</small>', html)
+    if (total is not None) and (len(total) > 0):
+        return int(math.ceil(int(total) / page_size))
+
+    return 1
+
+
+def get_gallery_links(html):
+    """Returns (page url, thumbnail url) of every cell of a gallery page"""
+    tab = search('<Table class="file_block">(.*?)</Table>', html)
+    return [(m.group(1), m.group(2)) for m in GALLERY_LINK.finditer(tab)]
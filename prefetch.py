@@ -0,0 +1,207 @@
+import asyncio
+import threading
+import traceback
+
+from PIL import Image
+
+from cache import get_cache, image_cache
+from engine import engine
+from fetch import GALLERY_PAGE_SIZE, DeadLinkError, get_page_model, get_thumb_key, get_gallery_key
+from imaging import open_scaled
+from page import get_gallery_links
+from providers import get_id
+
+# pages resolved ahead of the shown one in each direction
+PREFETCH_DEPTH = 1
+PREFETCH_PREVIOUS = False
+# also decode the main thumbnail of prefetched pages into the image cache
+PREFETCH_DECODE = False
+# prefetch requests in flight at a time, keeps foreground loads from waiting on them
+MAX_PREFETCH = 2
+
+# gallery pages prefetched on each side of the shown one
+GALLERY_PREFETCH_PAGES = 2
+
+
+class Prefetcher:
+    """Resolves the pages behind Next (and Previous) while the user looks at the current one"""
+
+    def __init__(self, cache_root):
+        self.cache_root = cache_root
+        self.future = None
+        self.idents = set()
+        self.semaphore = None
+        self.lock = threading.Lock()
+
+    def start(self, provider, model, proxies):
+        self.cancel()
+
+        directions = [lambda m: m.next_url]
+        if PREFETCH_PREVIOUS:
+            directions.append(lambda m: m.prev_url)
+
+        with self.lock:
+            self.future = engine.submit(self.prefetch(provider, model, directions, proxies))
+
+    def cancel(self, input_url=None):
+        """Stops prefetching unless the user goes to one of the pages being prefetched"""
+        with self.lock:
+            if self.future is None:
+                return
+
+            if (input_url is not None) and any(input_url.find(ident) >= 0 for ident in self.idents):
+                return
+
+            self.future.cancel()
+            self.future = None
+            self.idents = set()
+
+    async def prefetch(self, provider, model, directions, proxies):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(MAX_PREFETCH)
+
+        try:
+            await asyncio.gather(*[self.prefetch_direction(provider, model, get_url, proxies)
+                                   for get_url in directions])
+        except asyncio.CancelledError:
+            raise
+        except DeadLinkError:
+            pass
+        except BaseException as error:
+            print(error)
+            traceback.print_exc()
+
+    async def prefetch_direction(self, provider, model, get_url, proxies):
+        for _ in range(PREFETCH_DEPTH):
+            url = get_url(model)
+            if len(url) == 0:
+                return
+
+            model = await self.prefetch_page(provider, url, proxies)
+            if model is None:
+                return
+
+    async def prefetch_page(self, provider, url, proxies):
+        ident = get_id(provider, url)
+        if ident is None:
+            return None
+
+        disk_cache = get_cache(self.cache_root, provider.get_domen())
+        if disk_cache.is_dead(ident):
+            return None
+
+        with self.lock:
+            self.idents.add(ident)
+
+        model = get_page_model(disk_cache, provider, ident)
+        if model is None:
+            input_url = "https://" + provider.get_host() + "/" + ident
+            async with self.semaphore:
+                model = await engine.resolve_page(provider, ident, input_url, proxies, disk_cache)
+            if model is None:
+                return None
+
+        if len(model.thumb_url) == 0:
+            return model
+
+        thumb_key = get_thumb_key(model.thumb_url)
+        if not disk_cache.contains(thumb_key) and not disk_cache.is_dead(model.thumb_url):
+            async with self.semaphore:
+                image = await engine.download_image(model.thumb_url, proxies, 'thumb')
+            if image is None:
+                disk_cache.mark_dead(model.thumb_url)
+                return model
+
+            disk_cache.put(thumb_key, image, 'thumb')
+
+        if PREFETCH_DECODE and image_cache.get(model.thumb_url, None) is None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, decode_thumb, disk_cache, thumb_key, model.thumb_url, None)
+
+        return model
+
+
+def decode_thumb(disk_cache, thumb_key, thumb_url, width):
+    """Puts the cached thumbnail into the image cache, resized to width unless it is None"""
+    img_file = disk_cache.open(thumb_key)
+    if img_file is None:
+        return
+
+    with img_file:
+        if width is None:
+            img = Image.open(img_file)
+            img.load()
+        else:
+            img, _ = open_scaled(img_file, width)
+
+    image_cache.put(thumb_url, width, img)
+
+
+class GalleryPrefetcher:
+    """Loads the gallery pages around the shown one with their thumbnails resized for the grid"""
+
+    def __init__(self, cache_root, thumb_width):
+        self.cache_root = cache_root
+        self.thumb_width = thumb_width
+        self.futures = {}
+        self.semaphore = None
+        self.lock = threading.Lock()
+
+    def move(self, provider, gallery, page, page_count, proxies):
+        """Shifts the window to the shown page, pages that fall out of it are cancelled"""
+        first = max(1, page - GALLERY_PREFETCH_PAGES)
+        last = min(page_count, page + GALLERY_PREFETCH_PAGES)
+        # nearest pages first
+        wanted = sorted((p for p in range(first, last + 1) if p != page), key=lambda p: abs(p - page))
+
+        with self.lock:
+            for p in list(self.futures):
+                if p not in wanted:
+                    self.futures.pop(p).cancel()
+
+            for p in wanted:
+                future = self.futures.get(p)
+                if (future is None) or (future.done() and future.exception() is not None):
+                    self.futures[p] = engine.submit(self.prefetch_page(provider, gallery, p, proxies))
+
+    def cancel(self):
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures.clear()
+
+    async def prefetch_page(self, provider, gallery, page, proxies):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(MAX_PREFETCH)
+
+        disk_cache = get_cache(self.cache_root, provider.get_domen())
+        key = get_gallery_key(gallery, page)
+        html = disk_cache.get(key)
+        if (html is None) or (len(html) == 0) or not disk_cache.is_fresh(key):
+            async with self.semaphore:
+                response = await engine.download_gallery_page(provider, gallery, page, disk_cache, proxies)
+            if response.status_code == 200:
+                html = response.content
+
+        if (html is None) or (len(html) == 0):
+            return
+
+        loop = asyncio.get_running_loop()
+        for url, img_url in get_gallery_links(html.decode('utf-8'))[: GALLERY_PAGE_SIZE]:
+            if image_cache.get(img_url, self.thumb_width) is not None:
+                continue
+
+            thumb_key = get_thumb_key(img_url)
+            if not disk_cache.contains(thumb_key):
+                if disk_cache.is_dead(img_url):
+                    continue
+
+                async with self.semaphore:
+                    image = await engine.download_image(img_url, stage='thumb')
+                if image is None:
+                    disk_cache.mark_dead(img_url)
+                    continue
+
+                disk_cache.put(thumb_key, image, 'thumb')
+
+            await loop.run_in_executor(None, decode_thumb, disk_cache, thumb_key, img_url, self.thumb_width)
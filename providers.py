@@ -0,0 +1,200 @@
+import base64
+import binascii
+import re
+import traceback
+from abc import ABC, abstractmethod
+from urllib.parse import urlparse
+
+from page import FINAL_PAGE_SECTIONS, PICVIEW_SECTION, PageReader, get_variables
+
+# post form field names, the same two sets are shared by all providers
+SHORT_POST_PARAM = ('_0x161539', '_0xac7006')
+LONG_POST_PARAM = ('_0x6f3649', '_0x5754e8', '_0x58bd37', '_0x23f325', '_0x3e41de', '_0x1728a8', '_0x46dc6a',
+                   '_0x2a20de', '_0x1a0961', '_0x1008b5', '_0x301249')
+
+# how the original image url is found on the final page
+IMAGE_FROM_VARIABLES = 'variables'
+IMAGE_FROM_PICVIEW = 'picview'
+
+# the redirect page of a removed image
+FILE_NOT_FOUND = 'File Not Found'
+
+
+class AbstractProvider(ABC):
+    def __init__(self):
+        super().__init__()
+
+    @abstractmethod
+    def get_host(self):
+        pass
+
+    @abstractmethod
+    def get_domen(self):
+        pass
+
+    @abstractmethod
+    def get_redirect_url(self, html):
+        pass
+
+    @abstractmethod
+    def get_post_param(self, html):
+        pass
+
+    @abstractmethod
+    def get_image_url(self, html):
+        pass
+
+
+class ProviderSpec:
+    """Declarative description of an image host, a mirror is one more entry in SPECS
+
+    hosts: host names, the first one is used to build urls
+    redirect: variables whose concatenation is the base64 encoded redirect url, in concatenation order
+    post_param: variables whose concatenation is the name of the post form field
+    image: IMAGE_FROM_VARIABLES or IMAGE_FROM_PICVIEW
+    """
+
+    def __init__(self, domen, hosts, redirect, post_param, image):
+        self.domen = domen
+        self.hosts = hosts
+        self.redirect = redirect
+        self.post_param = post_param
+        self.image = image
+
+
+SPECS = [
+    ProviderSpec('imgrock', ('imgrock.pw',),
+                 ('_0x375c1e', '_0x14ff50', '_0x4817e7', '_0x53e80d', '_0x16777a', '_0x92afb7', '_0x31f1b4',
+                  '_0x18dc18', '_0x2c6182'),
+                 SHORT_POST_PARAM, IMAGE_FROM_VARIABLES),
+    ProviderSpec('imgview', ('imgview.pw',),
+                 ('_0x3edc55', '_0x388eb7', '_0x5f4353', '_0x51ca4d', '_0x2091c4', '_0x474995', '_0x5f000f',
+                  '_0x308cf0', '_0x39b490'),
+                 LONG_POST_PARAM, IMAGE_FROM_PICVIEW),
+    ProviderSpec('imgtown', ('imgtown.pw',),
+                 ('_0x375c1e', '_0x14ff50', '_0x4817e7', '_0x53e80d', '_0x16777a', '_0x92afb7', '_0x31f1b4',
+                  '_0x18dc18', '_0x2c6182'),
+                 LONG_POST_PARAM, IMAGE_FROM_PICVIEW),
+    ProviderSpec('imgoutlet', ('imgoutlet.pw',),
+                 ('_0x5f2b0', '_0x269158', '_0x337490', '_0x4c78db', '_0x19792c', '_0x4ae180', '_0x580e37',
+                  '_0xacf574', '_0x5aa778'),
+                 SHORT_POST_PARAM, IMAGE_FROM_VARIABLES),
+    ProviderSpec('imgmaze', ('imgmaze.pw',),
+                 ('_0x220856', '_0x421cf1', '_0x43582a', '_0x23d671', '_0x473131', '_0x1ab2d2', '_0x3b4d44',
+                  '_0x86fd3f', '_0x501afd'),
+                 LONG_POST_PARAM, IMAGE_FROM_PICVIEW),
+    ProviderSpec('imgdew', ('imgdew.pw',),
+                 ('_0x3edc55', '_0x388eb7', '_0x5f4353', '_0x51ca4d', '_0x2091c4', '_0x474995', '_0x5f000f',
+                  '_0x308cf0', '_0x39b490'),
+                 LONG_POST_PARAM, IMAGE_FROM_PICVIEW),
+]
+
+PICVIEW = re.compile(r'>Next.+?<img src="(.*?)" class="picview" alt=', re.MULTILINE | re.DOTALL)
+
+
+class Provider(AbstractProvider):
+    """Provider built from a ProviderSpec, its extractors are compiled once"""
+
+    def __init__(self, spec):
+        super().__init__()
+        self.spec = spec
+        self.ident_pattern = re.compile(r"https?://" + re.escape(spec.domen) + r"\.[a-z]+/(.+?)(?:/|$)")
+
+    def get_host(self):
+        return self.spec.hosts[0]
+
+    def get_domen(self):
+        return self.spec.domen
+
+    def get_redirect_url(self, html):
+        variables = get_variables(html)
+        try:
+            return base64.b64decode(''.join(variables[name] for name in self.spec.redirect))
+        except binascii.Error as ex:
+            print(ex)
+            traceback.print_exc()
+            return ''
+
+    def get_post_param(self, html):
+        variables = get_variables(html)
+        return ''.join(variables[name] for name in self.spec.post_param)
+
+    def get_image_url(self, html):
+        if self.spec.image == IMAGE_FROM_VARIABLES:
+            variables = get_variables(html)
+            return variables['_0xDB36'] + '/img/' + variables['_0xDB54']
+
+        found = PICVIEW.search(html)
+        return '' if found is None else found.group(1)
+
+    def find_image_url(self, html, picview_url):
+        """get_image_url() reusing the picview url page.scan_page already found, '' when it isn't there"""
+        if self.spec.image == IMAGE_FROM_VARIABLES:
+            variables = get_variables(html)
+            if ('_0xDB36' not in variables) or ('_0xDB54' not in variables):
+                return ''
+            return variables['_0xDB36'] + '/img/' + variables['_0xDB54']
+
+        return picview_url
+
+    def get_reader(self, stage):
+        """PageReader that knows when the page of a fetch chain stage has everything the chain uses"""
+        if stage == 'page':
+            return PageReader(variables=self.spec.redirect)
+        if stage == 'redirect':
+            return PageReader(variables=self.spec.post_param, stop=(FILE_NOT_FOUND,))
+
+        if self.spec.image == IMAGE_FROM_VARIABLES:
+            return PageReader(sections=FINAL_PAGE_SECTIONS, variables=('_0xDB36', '_0xDB54'))
+        return PageReader(sections=FINAL_PAGE_SECTIONS + (PICVIEW_SECTION,))
+
+    def get_id(self, url):
+        found = self.ident_pattern.search(url)
+        if (found is None) or (found.group(0) is None):
+            return None
+
+        return found.group(1)
+
+
+class ProviderRegistry:
+    """Providers indexed by host name and by domen (the host name without its top level domain)"""
+
+    def __init__(self, specs):
+        self.by_host = {}
+        self.by_domen = {}
+        for spec in specs:
+            self.add(spec)
+
+    def add(self, spec):
+        provider = Provider(spec)
+        self.by_domen[spec.domen] = provider
+        for host in spec.hosts:
+            self.by_host[host] = provider
+
+    def get(self, url):
+        # urls are often pasted without the scheme
+        host = urlparse(url if '//' in url else '//' + url).hostname
+        if host is None:
+            return None
+
+        if host.startswith('www.'):
+            host = host[4:]
+
+        provider = self.by_host.get(host)
+        if provider is not None:
+            return provider
+
+        # same site on another top level domain
+        labels = host.split('.')
+        return self.by_domen.get(labels[-2]) if len(labels) >= 2 else None
+
+
+registry = ProviderRegistry(SPECS)
+
+
+def get_provider(input_url):
+    return registry.get(input_url.strip())
+
+
+def get_id(provider, url):
+    return provider.get_id(url)
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import threading
+import traceback
+from collections import deque
+
+from fetch import Request
+
+# one host:port per line
+PROXY_FILE = 'proxy.txt'
+# rolling samples of every proxy, kept across runs
+STATS_FILE = 'proxy.json'
+
+# requests remembered per proxy for latency and error rate
+WINDOW = 20
+# proxies failing more often than this are only used when no other is left
+MAX_ERROR_RATE = 0.5
+# latency assumed for a proxy without samples, low enough that new proxies get tried
+DEFAULT_LATENCY = 1.0
+
+PROBE_URL = 'https://www.google.com/generate_204'
+PROBE_INTERVAL = 60
+
+
+def get_proxies(address):
+    """requests style proxies of one host:port"""
+    return {
+        "http": "http://" + address,
+        "https": "https://" + address
+    }
+
+
+def read_addresses(filename):
+    try:
+        with open(filename) as f:
+            addresses = [line.strip() for line in f]
+    except FileNotFoundError:
+        return []
+
+    return [address for address in addresses if len(address) > 0 and not address.startswith('#')]
+
+
+class ProxyStats:
+    def __init__(self, samples=()):
+        # latency in seconds, None for a failed request
+        self.samples = deque(samples, maxlen=WINDOW)
+        self.in_flight = 0
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def get_error_rate(self):
+        if len(self.samples) == 0:
+            return 0.0
+
+        return sum(1 for latency in self.samples if latency is None) / len(self.samples)
+
+    def get_latency(self):
+        latencies = [latency for latency in self.samples if latency is not None]
+        if len(latencies) == 0:
+            return DEFAULT_LATENCY if len(self.samples) == 0 else float('inf')
+
+        return sum(latencies) / len(latencies)
+
+    def is_healthy(self):
+        return self.get_error_rate() <= MAX_ERROR_RATE
+
+    def get_score(self):
+        """Expected latency, failures and requests already in flight make it worse"""
+        return self.get_latency() * (1 + 4 * self.get_error_rate()) * (1 + self.in_flight)
+
+
+class ProxyPool:
+    """Routes every request through the best healthy proxy, see Engine.through
+
+    Each request and background probe adds a latency (or failure) sample, so a proxy that dies mid-session
+    drops out and the retried stage goes through the next best one.
+    """
+
+    def __init__(self, addresses=(), stats_file=STATS_FILE, probe_url=PROBE_URL):
+        self.stats_file = stats_file
+        self.probe_url = probe_url
+        self.proxies = {}
+        self.saved = self.load_stats()
+        self.lock = threading.Lock()
+
+        for address in addresses:
+            self.add(address)
+
+    @classmethod
+    def from_file(cls, filename=PROXY_FILE, **kwargs):
+        return cls(read_addresses(filename), **kwargs)
+
+    def add(self, address):
+        with self.lock:
+            if address not in self.proxies:
+                self.proxies[address] = ProxyStats(self.saved.get(address, ()))
+
+    def get_addresses(self):
+        with self.lock:
+            return list(self.proxies)
+
+    def save(self, filename=PROXY_FILE):
+        with open(filename, 'w') as f:
+            for address in self.get_addresses():
+                f.write(address + '\n')
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def choose(self):
+        """Returns the address of the proxy to use for the next request"""
+        with self.lock:
+            if len(self.proxies) == 0:
+                return None
+
+            healthy = [(address, stats) for address, stats in self.proxies.items() if stats.is_healthy()]
+            candidates = healthy if len(healthy) > 0 else list(self.proxies.items())
+            address, stats = min(candidates, key=lambda item: item[1].get_score())
+            stats.in_flight += 1
+
+        return address
+
+    def release(self, address):
+        """Ends a request chosen by choose() without a sample, it was cancelled"""
+        with self.lock:
+            stats = self.proxies.get(address)
+            if stats is not None:
+                stats.in_flight = max(0, stats.in_flight - 1)
+
+    def report(self, address, latency):
+        """Ends a request chosen by choose(), latency None for a failure"""
+        self.release(address)
+        self.add_sample(address, latency)
+
+    def add_sample(self, address, latency):
+        with self.lock:
+            stats = self.proxies.get(address)
+            if stats is not None:
+                stats.add(latency)
+
+    async def probe_forever(self, engine, interval=PROBE_INTERVAL):
+        """Runs on the engine loop, keeps the samples of idle and failed proxies current"""
+        while True:
+            await asyncio.gather(*[self.probe(engine, address) for address in self.get_addresses()])
+            await asyncio.sleep(interval)
+
+    async def probe(self, engine, address):
+        try:
+            response = await engine.send(Request('GET', self.probe_url, stage='probe'), get_proxies(address))
+            latency = response.latency if response.status_code < 500 else None
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            latency = None
+
+        self.add_sample(address, latency)
+
+    def load_stats(self):
+        try:
+            with open(self.stats_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except BaseException as error:
+            print(error)
+            traceback.print_exc()
+            return {}
+
+    def save_stats(self):
+        with self.lock:
+            self.saved.update({address: list(stats.samples) for address, stats in self.proxies.items()})
+            saved = dict(self.saved)
+
+        with open(self.stats_file, 'w') as f:
+            json.dump(saved, f)
+
+    def stats(self):
+        """Returns {address: (latency, error rate, samples)}"""
+        with self.lock:
+            return {address: (stats.get_latency(), stats.get_error_rate(), len(stats.samples))
+                    for address, stats in self.proxies.items()}
+
+    def print_stats(self):
+        for address, (latency, error_rate, count) in sorted(self.stats().items(), key=lambda item: item[1][0]):
+            print(f"proxy {address}: {latency:.3f}s, {error_rate:.0%} errors over {count} requests")
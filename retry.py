@@ -0,0 +1,120 @@
+import asyncio
+import random
+import threading
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# failure classes
+TIMEOUT_ERROR = 'timeout'
+CONNECTION_ERROR = 'connection'
+SERVER_ERROR = 'server error'
+PARSE_ERROR = 'parse'
+OTHER_ERROR = 'other'
+
+RETRYABLE = {TIMEOUT_ERROR, CONNECTION_ERROR, SERVER_ERROR, PARSE_ERROR}
+
+# attempts per stage, a stage is one request of a chain and the parsing of its response
+MAX_ATTEMPTS = 5
+BASE_DELAY = 0.5
+MAX_DELAY = 8
+
+
+class StageError(Exception):
+    def __init__(self, stage, kind, message=''):
+        super().__init__(f'{stage}: {kind} {message}'.strip())
+        self.stage = stage
+        self.kind = kind
+
+
+class Backoff:
+    """Yielded by a fetch chain when a response didn't parse: the driver waits, then the chain repeats the stage"""
+
+    def __init__(self, stage, attempt):
+        self.stage = stage
+        self.attempt = attempt
+
+
+def classify(error):
+    if isinstance(error, StageError):
+        return error.kind
+
+    if isinstance(error, (requests.Timeout, asyncio.TimeoutError, TimeoutError)):
+        return TIMEOUT_ERROR
+
+    if isinstance(error, (requests.ConnectionError, requests.exceptions.ChunkedEncodingError, ConnectionError)):
+        return CONNECTION_ERROR
+
+    if (aiohttp is not None) and isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return CONNECTION_ERROR
+
+    return OTHER_ERROR
+
+
+class RetryPolicy:
+    """Retries a single failed stage with jittered exponential backoff and counts the retries per stage"""
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = {}
+        self.lock = threading.Lock()
+
+    def get_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def count(self, stage, kind):
+        with self.lock:
+            counts = self.retries.setdefault(stage, {})
+            counts[kind] = counts.get(kind, 0) + 1
+
+    def check(self, stage, kind, attempt):
+        """Counts the retry and returns its delay, raises when the stage ran out of attempts"""
+        if (kind not in RETRYABLE) or (attempt + 1 >= self.max_attempts):
+            raise StageError(stage, kind, f'after {attempt + 1} attempts')
+
+        self.count(stage, kind)
+        return self.get_delay(attempt)
+
+    async def backoff_async(self, request):
+        await asyncio.sleep(self.check(request.stage, PARSE_ERROR, request.attempt))
+
+    async def call_async(self, stage, send):
+        """Returns await send(), repeated on timeouts, connection errors and 5xx responses"""
+        attempt = 0
+        while True:
+            try:
+                response = await send()
+            except asyncio.CancelledError:
+                raise
+            except BaseException as error:
+                kind = classify(error)
+                if (kind not in RETRYABLE) or (attempt + 1 >= self.max_attempts):
+                    raise
+                self.count(stage, kind)
+                await asyncio.sleep(self.get_delay(attempt))
+                attempt += 1
+                continue
+
+            if (response.status_code < 500) or (attempt + 1 >= self.max_attempts):
+                return response
+
+            self.count(stage, SERVER_ERROR)
+            await asyncio.sleep(self.get_delay(attempt))
+            attempt += 1
+
+    def stats(self):
+        with self.lock:
+            return {stage: dict(counts) for stage, counts in self.retries.items()}
+
+    def print_stats(self):
+        for stage, counts in sorted(self.stats().items()):
+            print(f"{stage} retries: " + ', '.join(f'{kind} {count}' for kind, count in sorted(counts.items())))
+
+
+retry_policy = RetryPolicy()
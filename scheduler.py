@@ -0,0 +1,115 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+# requests in flight to one host at a time
+PER_HOST = 6
+# requests in flight through one proxy at a time
+PER_PROXY = 16
+# download budget over all hosts in bytes per second, None for unlimited
+BYTES_PER_SECOND = None
+
+
+class ByteBudget:
+    """Token bucket refilled at rate bytes per second, holds at most one second worth so bursts are smoothed"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def consume(self, size):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        # goes into debt, the caller waits until it is paid back
+        self.tokens -= size
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class Queue:
+    """Connection cap of one host or proxy with its queue depth metrics"""
+
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.requests = 0
+        self.wait_time = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        start = time.monotonic()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.wait_time += time.monotonic() - start
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+
+class Scheduler:
+    """Caps the concurrent requests per host and per proxy and the download rate, runs on the engine loop"""
+
+    def __init__(self, per_host=PER_HOST, per_proxy=PER_PROXY, bytes_per_second=BYTES_PER_SECOND):
+        self.per_host = per_host
+        self.per_proxy = per_proxy
+        self.budget = None if bytes_per_second is None else ByteBudget(bytes_per_second)
+        self.hosts = {}
+        self.proxies = {}
+
+    def get_queue(self, queues, key, limit):
+        queue = queues.get(key)
+        if queue is None:
+            queue = Queue(limit)
+            queues[key] = queue
+
+        return queue
+
+    @asynccontextmanager
+    async def slot(self, url, proxy=None):
+        """Waits for a free connection to the host of url (and through the proxy)"""
+        host_queue = self.get_queue(self.hosts, urlparse(url).netloc, self.per_host)
+        if proxy is None:
+            async with host_queue.slot():
+                yield
+            return
+
+        async with self.get_queue(self.proxies, proxy, self.per_proxy).slot(), host_queue.slot():
+            yield
+
+    async def consume(self, size):
+        """Accounts downloaded bytes against the budget, waits when it is exceeded"""
+        if self.budget is not None:
+            await self.budget.consume(size)
+
+    def stats(self):
+        """Returns {host or proxy: (requests, in flight, waiting, max waiting, average wait)}"""
+        result = {}
+        for queues in (self.hosts, self.proxies):
+            for key, queue in list(queues.items()):
+                result[key] = (queue.requests, queue.in_flight, queue.waiting, queue.max_waiting,
+                               queue.wait_time / max(1, queue.requests))
+
+        return result
+
+    def print_stats(self):
+        for key, (count, in_flight, waiting, max_waiting, wait) in sorted(self.stats().items()):
+            print(f"{key}: {count} requests, {in_flight} in flight, {waiting} queued "
+                  f"(max {max_waiting}, avg wait {wait:.3f}s)")
+
+
+scheduler = Scheduler()
@@ -0,0 +1,76 @@
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fetch import HEADERS
+
+# connections kept open per host and proxy
+POOL_SIZE = 10
+KEEP_ALIVE = True
+
+
+class SessionPool:
+    """Long-lived sessions shared by all threads, one per host and proxy so connections are reused"""
+
+    def __init__(self, pool_size=POOL_SIZE, keep_alive=KEEP_ALIVE):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, proxies=None):
+        key = (urlparse(url).netloc, None if proxies is None else proxies.get('https'))
+        with self.lock:
+            http_session = self.sessions.get(key)
+            if http_session is None:
+                http_session = self.create_session()
+                self.sessions[key] = http_session
+
+        return http_session
+
+    def create_session(self):
+        http_session = requests.Session()
+        http_session.headers.update(HEADERS)
+        if not self.keep_alive:
+            http_session.headers['Connection'] = 'close'
+
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, pool_block=False)
+        http_session.mount('http://', adapter)
+        http_session.mount('https://', adapter)
+
+        return http_session
+
+    def stats(self):
+        """Returns {host: (connections opened, requests sent)}, requests well above connections means reuse"""
+        with self.lock:
+            sessions = list(self.sessions.values())
+
+        result = {}
+        for http_session in sessions:
+            adapter = http_session.get_adapter('https://')
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                for pool_key in manager.pools.keys():
+                    pool = manager.pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    host = pool.host
+                    connections, count = result.get(host, (0, 0))
+                    result[host] = (connections + pool.num_connections, count + pool.num_requests)
+
+        return result
+
+    def print_stats(self):
+        for host, (connections, count) in sorted(self.stats().items()):
+            print(f"{host}: {count} requests over {connections} connections")
+
+    def close(self):
+        with self.lock:
+            for http_session in self.sessions.values():
+                http_session.close()
+            self.sessions.clear()
+
+
+session_pool = SessionPool()
@@ -1,45 +1,41 @@
-import base64
-import binascii
 import datetime
 import io
 import logging
-import math
 import os
-import re
 import time
 import traceback
-from abc import ABC, abstractmethod
+from concurrent.futures import CancelledError
 from concurrent.futures.thread import ThreadPoolExecutor
 from functools import partial
 from tkinter import Tk, Button, Image, Label, Menu, END, Scrollbar, LEFT, Y, \
     BOTH, RIGHT, VERTICAL, Frame, StringVar, SUNKEN, W, X, NSEW, Grid, Canvas, HORIZONTAL, NW, BOTTOM, BooleanVar, \
     Checkbutton, DISABLED, NORMAL, Toplevel, EW, ttk
 from tkinter.ttk import Entry
-from urllib.parse import urlparse
 
 import clipboard
-import requests
 from PIL import Image, ImageTk
 
-DEBUG = False
-
-USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:68.0) Gecko/20100101 Firefox/68.0'
-
-HEADERS = {
-    'User-agent': USER_AGENT,
-}
+from cache import get_cache, image_cache
+from engine import LoadToken, engine
+from fetch import GALLERY_PAGE_SIZE, DeadLinkError, get_page_model, get_thumb_key, get_original_key, get_gallery_key
+from imaging import open_scaled, scale
+from page import get_page_count, get_gallery_links
+from prefetch import Prefetcher, GalleryPrefetcher
+from providers import get_provider, get_id
+from proxy import PROXY_FILE, ProxyPool
+from retry import StageError
 
 OUTPUT = datetime.datetime.now().strftime('%Y.%m.%d')
 CACHE = 'cache'
 LOGS = 'logs'
 
-TIMEOUT = (3.05, 9.05)
 PAD = 5
 IMG_WIDTH = 120
 MAIN_IMG_WIDTH = 450
-MAX_ERRORS = 5
 
 executor = ThreadPoolExecutor(max_workers=20)
+# thumbnails of a panel are fetched and decoded concurrently, see reconfigure_buttons
+thumb_executor = ThreadPoolExecutor(max_workers=16)
 
 root = Tk()
 
@@ -59,12 +55,15 @@ class MainWindow:
         self.resized = False
         self.thumb_prefix = None
         self.proxies = None
+        self.proxy_pool = ProxyPool.from_file(PROXY_FILE)
+        self.probes = None
         self.gallery_url = None
         self.hist_stack = []
         self.fwd_stack = []
-        self.interrupt = False
+        self.token = LoadToken()
         self.thumb_url = None
         self.image_url = None
+        self.prefetcher = Prefetcher(CACHE)
 
         self.menu_bar = Menu(root)
         self.menu_bar.add_command(label="<< Back", command=self.back_in_history)
@@ -121,12 +120,9 @@ class MainWindow:
         self.btn_force = Button(frm_top, text="Force load", command=self.force_load_image)
         self.btn_force.pack(side=LEFT)
 
-        try:
-            with open("proxy.txt") as f:
-                self.sv_proxy.set(f.readline().strip())
-        except BaseException as error:
-            print(error)
-            traceback.print_exc()
+        addresses = self.proxy_pool.get_addresses()
+        if len(addresses) > 0:
+            self.sv_proxy.set(addresses[0])
 
         self.btn_image = Button(frm_image, command=self.resize_image)
         self.btn_image.bind("<Button-3>", self.load_original_image_in_thread)
@@ -175,59 +171,54 @@ class MainWindow:
 
     def load_page_in_thread(self, input_url, remember=True, ignore_cache=False):
         self.set_controls_state(DISABLED)
-        self.interrupt = False
-        future = executor.submit(self.load_image_retry, input_url, remember, ignore_cache)
-        future.add_done_callback(lambda f: self.set_controls_state(NORMAL))
-
-    def load_image_retry(self, input_url, remember, ignore_cache):
-        global root
-
+        # whatever the previous load still does is dropped
+        self.token.cancel()
+        self.token = token = LoadToken()
+        self.hide_download_progress()
+        self.prefetcher.cancel(input_url)
+        future = token.add(executor.submit(self.load_image_guarded, input_url, remember, ignore_cache, token))
+        future.add_done_callback(lambda f: self.set_controls_state(NORMAL) if token is self.token else None)
+
+    def load_image_guarded(self, input_url, remember, ignore_cache, token):
+        """Failed stages are retried inside the fetch chain (see retry.py), the whole load is not repeated"""
         try:
-            err_count = 0
-            while err_count < MAX_ERRORS:
-                root.after_idle(self.set_undefined_state)
-                if self.load_image(input_url, remember, ignore_cache):
-                    break
-
-                if self.interrupt:
-                    break
-
-                err_count += 1
+            after_idle(token, self.set_undefined_state)
+            self.load_image(input_url, remember, ignore_cache, token)
+        except CancelledError:
+            print("Cancelled: " + input_url)
+        except DeadLinkError as error:
+            print("Dead link: " + str(error))
+            after_idle(token, self.status.set, "File Not Found: " + str(error))
+        except StageError as error:
+            print("Failed: " + str(error))
+            after_idle(token, self.status.set, "Failed: " + str(error))
         except BaseException as error:
             print("Exception URL: " + input_url)
             print(error)
             traceback.print_exc()
 
-    def load_image(self, input_url, remember, ignore_cache):
+    def load_image(self, input_url, remember, ignore_cache, token):
         global root
 
         if len(input_url) == 0:
             return False
 
-        root.after_idle(self.sv_url.set, input_url)
+        after_idle(token, self.sv_url.set, input_url)
 
         self.provider = self.get_provider()
         if self.provider is None:
             return False
 
-        cache_path = os.path.join(CACHE, self.provider.get_domen())
-        if not os.path.exists(cache_path):
-            os.mkdir(cache_path)
-
         proxy = self.sv_proxy.get().strip()
         if self.use_proxy.get() and len(proxy.strip()) > 0:
-            self.proxies = {
-                "http": "http://" + proxy,
-                "https": "https://" + proxy
-            }
-            with open("proxy.txt", "w") as f:
-                f.write(proxy)
+            # requests go through the best proxy of the pool, the typed one joins it
+            if proxy not in self.proxy_pool.get_addresses():
+                self.proxy_pool.add(proxy)
+                self.proxy_pool.save(PROXY_FILE)
+            self.proxies = self.proxy_pool
         else:
             self.proxies = None
 
-        http_session = requests.Session()
-        http_session.headers.update(HEADERS)
-
         ident = self.get_id(input_url)
         if ident is None:
             print("ident is None")
@@ -235,19 +226,20 @@ class MainWindow:
 
         input_url = "https://" + self.provider.get_host() + "/" + ident
 
-        root.after_idle(root.title, input_url)
+        after_idle(token, root.title, input_url)
 
         try:
-            html = self.get_from_cache(ident)
-            if ignore_cache or (html is None) or (len(html) == 0):
-                html = self.get_final_page(ident, input_url, http_session)
-
-            if (html is None) or (len(html) == 0):
-                return False
-
-            html = html.decode('utf-8')
+            model = None if ignore_cache else self.get_page_from_cache(ident)
+            if (model is None) and not ignore_cache and self.is_dead(ident):
+                raise DeadLinkError(input_url)
+
+            if model is None:
+                model = engine.call(engine.resolve_page(self.provider, ident, input_url, self.proxies,
+                                                        get_cache(CACHE, self.provider.get_domen())), token)
+                if model is None:
+                    return False
 
-            if not self.render_page(ident, html, http_session):
+            if not self.render_page(ident, model, token):
                 return False
 
             if remember and (input_url is not None):
@@ -259,105 +251,43 @@ class MainWindow:
                 else:
                     self.fwd_stack.clear()
 
+            self.prefetcher.start(self.provider, model, self.proxies)
+
+        except (CancelledError, DeadLinkError, StageError):
+            raise
         except BaseException as error:
             print("Exception URL: " + input_url)
             print(error)
             traceback.print_exc()
             return False
-        finally:
-            http_session.close()
 
         return True
 
-    def get_final_page(self, ident, input_url, http_session):
-        global root
-
-        response = http_session.get(input_url, proxies=self.proxies, timeout=TIMEOUT)
-        if response.status_code == 404:
-            print("input_url response.status_code == 404")
-            return None
-
-        html = response.content.decode('utf-8')
-
-        if DEBUG:
-            with open('1.html', 'w') as f:
-                f.write(html)
-
-        # sometimes this functions fails (i don't want to tamper with this)
-        redirect_url = self.provider.get_redirect_url(html)
-        if redirect_url is not None:
-            if len(redirect_url) == 0:
-                print("(redirect_url is None) or (len(redirect_url) == 0)")
-                return None
-
-            http_session.headers.update({'Referer': input_url})
-            response = http_session.get(redirect_url, proxies=self.proxies, timeout=TIMEOUT)
-            if response.status_code == 404:
-                print("redirect_url response.status_code == 404")
-                return None
-
-            html = response.content.decode('utf-8')
-
-            if DEBUG:
-                with open('2.html', 'w') as f:
-                    f.write(html)
+    def get_page_from_cache(self, ident):
+        return get_page_model(get_cache(CACHE, self.provider.get_domen()), self.provider, ident)
 
-        pos = html.find('File Not Found')
-        if pos >= 0:
-            print("File Not Found: " + input_url)
-            return None
-
-        param = self.provider.get_post_param(html)
-        if len(param) == 0:
-            print("len(param) == 0")
-            return None
-
-        post_fields = {
-            'op': 'view',
-            'id': ident,
-            'pre': 1,
-            param: 1
-        }
-        response = http_session.post(redirect_url, data=post_fields, proxies=self.proxies, timeout=TIMEOUT)
-        if response.status_code == 404:
-            print("POST: redirect_url response.status_code == 404")
-            return None
-
-        html = response.content
-
-        if DEBUG:
-            with open('3.html', 'wb') as f:
-                f.write(html)
-
-        self.put_to_cache(ident, html)
-
-        return html
-
-    def render_page(self, ident, html, http_session):
-        self.thumb_url = get_thumb(html)
+    def render_page(self, ident, model, token):
+        token.check()
+        self.thumb_url = model.thumb_url
         if (self.thumb_url is None) or (len(self.thumb_url) == 0):
             print("len(thumb_url) == 0")
             return False
 
         slash_pos = self.thumb_url.rfind('/')
         self.thumb_prefix = self.thumb_url[: slash_pos + 1]
-        thumb_filename = self.thumb_url[slash_pos + 1:]
-        dot_pos = thumb_filename.rfind('.')
-        thumb_filename = thumb_filename[: dot_pos]
+        thumb_filename = get_thumb_key(self.thumb_url)
 
-        self.gallery_url = search('href="([^"]*)">More from gallery</a>', html)
+        self.gallery_url = model.gallery_url
 
-        self.reconfigure_prev_button(http_session, html)
-        self.reconfigure_next_button(http_session, html)
+        token.add(thumb_executor.submit(self.reconfigure_nav_button, self.btn_prev, model.prev_url, token))
+        token.add(thumb_executor.submit(self.reconfigure_nav_button, self.btn_next, model.next_url, token))
 
-        executor.submit(self.reconfigure_left_buttons, html)
-        executor.submit(self.reconfigure_right_buttons, html)
+        token.add(executor.submit(self.reconfigure_buttons, self.left_buttons, model.author_links, token))
+        token.add(executor.submit(self.reconfigure_buttons, self.right_buttons, model.gallery_links, token))
 
-        self.image_url = self.provider.get_image_url(html)
+        self.image_url = model.image_url
 
-        fname = get_filename(self.image_url)
-        dot_pos = fname.rfind('.')
-        self.original_image_name = fname[: dot_pos] + '_' + ident
+        self.original_image_name = get_original_key(self.image_url, ident)
         self.original_image = self.get_from_cache(self.original_image_name)
 
         bg_color = 'green'
@@ -367,37 +297,47 @@ class MainWindow:
             self.resized = False
 
         if (self.original_image is None) or (len(self.original_image) == 0):
-            response = http_session.get(self.thumb_url, proxies=self.proxies, timeout=TIMEOUT)
-            if response.status_code == 404:
-                print("image_url response.status_code == 404")
-                return False
+            if self.is_dead(self.thumb_url):
+                raise DeadLinkError(self.thumb_url)
 
-            self.original_image = response.content
+            self.original_image = engine.call(engine.download_image(self.thumb_url, self.proxies, 'thumb'), token)
+            if self.original_image is None:
+                print("image_url response.status_code == 404")
+                self.mark_dead(self.thumb_url)
+                raise DeadLinkError(self.thumb_url)
 
             # if DEBUG:
             #     with open(self.original_image_name, 'wb') as f:
             #         f.write(self.original_image)
 
-            self.put_to_cache(thumb_filename, self.original_image)
+            self.put_to_cache(thumb_filename, self.original_image, 'thumb')
             bg_color = 'red'
             self.resized = False
 
-        img = Image.open(io.BytesIO(self.original_image))
-        w, h = img.size
-        k = MAIN_IMG_WIDTH / w
-        img_resized = img.resize((MAIN_IMG_WIDTH, int(h * k)))
+        if self.resized:
+            # the original is decoded at full size only when it is shown, see resize_image
+            img = None
+            img_resized, (w, h) = open_scaled(io.BytesIO(self.original_image), MAIN_IMG_WIDTH)
+        else:
+            # the prefetcher may have decoded the thumbnail already
+            img = image_cache.get(self.thumb_url, None)
+            if img is None:
+                img = Image.open(io.BytesIO(self.original_image))
+            w, h = img.size
+            img_resized = scale(img, MAIN_IMG_WIDTH)
 
-        root.after_idle(root.title, f"{root.title()} ({w}x{h})")
+        token.check()
+        after_idle(token, root.title, f"{root.title()} ({w}x{h})")
 
-        self.main_image_orig = ImageTk.PhotoImage(img)
+        self.main_image_orig = None if img is None else ImageTk.PhotoImage(img)
         self.main_image = ImageTk.PhotoImage(img_resized)
 
         photo_image = self.main_image if self.resized else self.main_image_orig
-        root.after_idle(self.btn_image.config,
-                        {'image': photo_image, 'background': bg_color})
+        after_idle(token, self.btn_image.config,
+                   {'image': photo_image, 'background': bg_color})
 
         if os.path.exists(os.path.join(OUTPUT, self.original_image_name)):
-            root.after_idle(self.btn_save.config, {'background': 'green'})
+            after_idle(token, self.btn_save.config, {'background': 'green'})
 
         return True
 
@@ -421,8 +361,21 @@ class MainWindow:
         self.fh_hist.close()
         self.hist_logger.removeHandler(self.fh_hist)
 
+        if self.probes is not None:
+            self.probes.cancel()
+        self.proxy_pool.save_stats()
+        self.proxy_pool.print_stats()
+        engine.print_stats()
+
     def calcel(self):
-        self.interrupt = True
+        self.token.cancel()
+        # the page stays on screen, what is started from it now (the original download) needs a live token
+        self.token = LoadToken()
+        # the cancelled download can't hide its progress any more
+        self.hide_download_progress()
+        self.prefetcher.cancel()
+        self.status.set("Cancelled")
+        self.set_controls_state(NORMAL)
 
     def set_undefined_state(self):
         global root
@@ -482,90 +435,50 @@ class MainWindow:
         return buttons
 
     def resize_image(self):
+        if self.resized and (self.main_image_orig is None) and (self.original_image is not None):
+            self.main_image_orig = ImageTk.PhotoImage(Image.open(io.BytesIO(self.original_image)))
         self.btn_image.config(image=(self.main_image_orig if self.resized else self.main_image))
         self.resized = not self.resized
         self.frm_main.scroll_top_left()
 
     def get_id(self, url):
-        found = re.search(r"https?://" + self.provider.get_domen() + r"\.[a-z]+/(.+?)(?:/|$)", url)
-        if (found is None) or (found.group(0) is None):
-            return None
-
-        return found.group(1)
-
-    def reconfigure_left_buttons(self, html):
-        tab = get_more_from_author(html)
-        self.reconfigure_buttons(self.left_buttons, tab)
-
-    def reconfigure_right_buttons(self, html):
-        tab = get_more_from_gallery(html)
-        self.reconfigure_buttons(self.right_buttons, tab)
-
-    def reconfigure_prev_button(self, http_session, html):
-        url = get_prev_url(html)
-        if len(url) == 0:
-            return
-
-        ident = self.get_id(url)
-        img_url = self.thumb_prefix + ident + '_t.jpg'
-        self.reconfigure_button(http_session, self.btn_prev, url, img_url)
+        return get_id(self.provider, url)
 
-    def reconfigure_next_button(self, http_session, html):
-        url = get_next_url(html)
+    def reconfigure_nav_button(self, btn, url, token):
+        """Runs on the thumb pool, nobody waits for it, so errors are printed here"""
         if len(url) == 0:
             return
 
-        ident = self.get_id(url)
-        img_url = self.thumb_prefix + ident + '_t.jpg'
-        self.reconfigure_button(http_session, self.btn_next, url, img_url)
-
-    def reconfigure_button(self, http_session, btn, url, img_url):
-        global root
-
-        filename = get_filename(img_url)
-        dot_pos = filename.rfind('.')
-        filename = filename[: dot_pos]
-        bg_color = "green"
-        image = self.get_from_cache(filename)
-        if (image is None) or (len(image) == 0):
-            image = download_image(http_session, img_url)
-            self.put_to_cache(filename, image)
-            bg_color = "red"
-
-        if (image is None) or (len(image) == 0):
-            return
-
-        img = Image.open(io.BytesIO(image))
-        w, h = img.size
-        k = IMG_WIDTH / w
-        img_resized = img.resize((IMG_WIDTH, int(h * k)))
-        photo_image = ImageTk.PhotoImage(img_resized)
-        if photo_image is None:
-            return
-
-        root.after_idle(btn.set_values, url, partial(self.load_page_in_thread, url),
-                        photo_image, bg_color)
-
-    def reconfigure_buttons(self, buttons, html):
-        http_session = requests.Session()
-        http_session.headers.update(HEADERS)
-
         try:
-            for btn in buttons:
-                btn.reset()
-
-            i = 0
-            for m in re.finditer('<td>.*?href="(.*?)".*?src="(.*?)".*?</td>', html, re.MULTILINE | re.DOTALL):
-                self.reconfigure_button(http_session, buttons[i], m.group(1), m.group(2))
-                i += 1
+            ident = self.get_id(url)
+            if ident is None:
+                print("ident is None: " + url)
+                return
+
+            img_url = self.thumb_prefix + ident + '_t.jpg'
+            self.reconfigure_button(btn, url, img_url, token)
+        except CancelledError:
+            pass
         except BaseException as error:
             print(error)
             traceback.print_exc()
-        finally:
-            http_session.close()
+
+    def reconfigure_button(self, btn, url, img_url, token):
+        fill_button(get_cache(CACHE, self.provider.get_domen()), self.load_page_in_thread, btn, url, img_url, token)
+
+    def reconfigure_buttons(self, buttons, links, token):
+        for btn in buttons:
+            btn.reset()
+
+        fill_buttons(partial(self.reconfigure_button, token=token), buttons, links, token)
 
     def on_use_proxy_change(self, *args):
+        if self.probes is not None:
+            self.probes.cancel()
+            self.probes = None
+
         if self.use_proxy.get():
+            self.probes = engine.submit(self.proxy_pool.probe_forever(engine))
             self.entry_proxy.config(state=NORMAL)
             self.entry_proxy.focus_set()
             self.entry_proxy.selection_range(0, END)
@@ -573,33 +486,7 @@ class MainWindow:
             self.entry_proxy.config(state=DISABLED)
 
     def get_provider(self):
-        input_url = self.sv_url.get()
-
-        pos = input_url.find(ImgRock.DOMEN)
-        if pos >= 0:
-            return ImgRock()
-
-        pos = input_url.find(ImgView.DOMEN)
-        if pos >= 0:
-            return ImgView()
-
-        pos = input_url.find(ImgTown.DOMEN)
-        if pos >= 0:
-            return ImgTown()
-
-        pos = input_url.find(ImgOutlet.DOMEN)
-        if pos >= 0:
-            return ImgOutlet()
-
-        pos = input_url.find(ImgMaze.DOMEN)
-        if pos >= 0:
-            return ImgMaze()
-
-        pos = input_url.find(ImgDew.DOMEN)
-        if pos >= 0:
-            return ImgDew()
-
-        return None
+        return get_provider(self.sv_url.get())
 
     def view_gallery_url(self):
         if (self.gallery_url is None) or (len(self.gallery_url) == 0):
@@ -623,24 +510,16 @@ class MainWindow:
         self.load_page_in_thread(self.fwd_stack[-1])
 
     def get_from_cache(self, filename):
-        full_path = os.path.join(CACHE, self.provider.get_domen(), filename)
-        if not os.path.exists(full_path):
-            return None
+        return get_cache(CACHE, self.provider.get_domen()).get(filename)
 
-        mod_time = time.time()
-        os.utime(full_path, (mod_time, mod_time))
+    def is_dead(self, key):
+        return get_cache(CACHE, self.provider.get_domen()).is_dead(key)
 
-        with open(full_path, 'rb') as f:
-            return f.read()[:: -1]
-
-    def put_to_cache(self, filename, data):
-        if (data is None) or (len(data) == 0):
-            return
+    def mark_dead(self, key):
+        get_cache(CACHE, self.provider.get_domen()).mark_dead(key)
 
-        full_path = os.path.join(CACHE, self.provider.get_domen(), filename)
-
-        with open(full_path, 'wb') as f:
-            f.write(data[:: -1])
+    def put_to_cache(self, filename, data, content_type=None):
+        get_cache(CACHE, self.provider.get_domen()).put(filename, data, content_type)
 
     def set_controls_state(self, status):
         self.btn_prev.config(state=status)
@@ -666,38 +545,70 @@ class MainWindow:
             self.progress_bar.pack_forget()
             self.progress_bar.stop()
 
+    def on_download_progress(self, token, done, total):
+        after_idle(token, self.show_download_progress, done, total)
+
+    def show_download_progress(self, done, total):
+        if total is None:
+            self.status.set(f"{self.image_url}: {done // 1024} KiB")
+            self.progress_bar.config(mode='indeterminate')
+        else:
+            self.status.set(f"{self.image_url}: {done // 1024} of {total // 1024} KiB")
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate', maximum=total, value=done)
+
+        if not self.progress_bar.winfo_ismapped():
+            self.progress_bar.pack(side=LEFT)
+            if total is None:
+                self.progress_bar.start()
+
+    def hide_download_progress(self):
+        self.progress_bar.stop()
+        self.progress_bar.pack_forget()
+        self.progress_bar.config(mode='indeterminate', value=0)
+
     def load_original_image_in_thread(self, event):
-        executor.submit(self.load_original_image)
+        self.token.add(executor.submit(self.load_original_image, self.token))
 
-    def load_original_image(self):
-        response = requests.get(self.image_url, proxies=self.proxies, timeout=TIMEOUT)
-        if response.status_code == 404:
-            print("image_url response.status_code == 404")
+    def load_original_image(self, token):
+        after_idle(token, self.show_download_progress, 0, None)
+        try:
+            self.original_image = engine.call(
+                engine.download_original(self.image_url, get_cache(CACHE, self.provider.get_domen()),
+                                         self.original_image_name, self.proxies,
+                                         partial(self.on_download_progress, token)), token)
+        except CancelledError:
+            # the partial file is kept, the next try resumes it
+            print("Cancelled: " + self.image_url)
             return
+        except BaseException as error:
+            print("Exception URL: " + self.image_url)
+            print(error)
+            traceback.print_exc()
+            after_idle(token, self.status.set, "Download failed, it resumes on the next try: " + str(error))
+            return
+        finally:
+            after_idle(token, self.hide_download_progress)
 
-        self.original_image = response.content
-
-        # if DEBUG:
-        #     with open(self.original_image_name, 'wb') as f:
-        #         f.write(self.original_image)
+        if self.original_image is None:
+            print("image_url response.status_code == 404")
+            return
 
-        self.put_to_cache(self.original_image_name, self.original_image)
         bg_color = 'red'
 
         self.resized = True
 
-        img = Image.open(io.BytesIO(self.original_image))
-        w, h = img.size
-        k = MAIN_IMG_WIDTH / w
-        img_resized = img.resize((MAIN_IMG_WIDTH, int(h * k)))
+        img_resized, (w, h) = open_scaled(io.BytesIO(self.original_image), MAIN_IMG_WIDTH)
 
-        root.after_idle(root.title, f"{root.title()} ({w}x{h})")
+        token.check()
+        after_idle(token, root.title, f"{root.title()} ({w}x{h})")
 
-        self.main_image_orig = ImageTk.PhotoImage(img)
+        # decoded at full size only when it is shown, see resize_image
+        self.main_image_orig = None
         self.main_image = ImageTk.PhotoImage(img_resized)
 
-        root.after_idle(self.btn_image.config,
-                        {'image': self.main_image, 'background': bg_color})
+        after_idle(token, self.btn_image.config,
+                   {'image': self.main_image, 'background': bg_color})
 
 
 class ScrollFrame(Frame):
@@ -785,393 +696,64 @@ class LinkButton(Button):
         self.link = url
 
 
-def download_image(http_session, url):
-    response = http_session.get(url, timeout=TIMEOUT)
-    if response.status_code == 404:
-        return None
-
-    image = response.content
-
-    # if DEBUG:
-    #     with open(get_filename(url), 'wb') as f:
-    #         f.write(image)
-
-    return image
-
-
-def get_filename(url):
-    res = urlparse(url)
-    fname = os.path.basename(res.path)
-
-    if fname.endswith(".html"):
-        return fname[:-5]
-
-    return fname
-
-
-def search(pattern, string):
-    found = re.search(pattern, string, re.MULTILINE | re.DOTALL)
-    if (found is None) or (found.group(0) is None):
-        return ""
-
-    return found.group(1)
-
-
-def get_next_url(html):
-    return search('< Previous.+?<a style=.+?href="(.*?)"><span.*?>Next', html)
-
-
-def get_prev_url(html):
-    return search('<a style=.+?href="(.*?)"><span.*?>< Previous', html)
-
+def fill_buttons(reconfigure_button, buttons, links, token):
+    """Fetches, decodes and paints all thumbnails of a panel at once, returns when all are done"""
+    futures = [token.add(thumb_executor.submit(reconfigure_button, btn, url, img_url))
+               for btn, (url, img_url) in zip(buttons, links)]
 
-def get_more_from_author(html):
-    tab = search('<td align="left".*?<table>(.*?)</table>.*?</td>', html)
-    return tab
-
-
-def get_more_from_gallery(html):
-    tab = search('<td align="right".*?<table>(.*?)</table>.*?</td>', html)
-    return tab
-
-
-def get_thumb(html):
-    return search('\[IMG\](.*?)\[/IMG\]', html)
-
-
-class AbstractProvider(ABC):
-    def __init__(self):
-        super().__init__()
-
-    @abstractmethod
-    def get_host(self):
-        pass
-
-    @abstractmethod
-    def get_domen(self):
-        pass
-
-    @abstractmethod
-    def get_redirect_url(self, html):
-        pass
-
-    @abstractmethod
-    def get_post_param(self, html):
-        pass
-
-    @abstractmethod
-    def get_image_url(self, html):
-        pass
-
-
-class ImgRock(AbstractProvider):
-    DOMEN = "imgrock"
-
-    def __init__(self):
-        super().__init__()
-
-    def get_host(self):
-        return "imgrock.pw"
-
-    def get_domen(self):
-        return ImgRock.DOMEN
-
-    def get_redirect_url(self, html):
-        try:
-            _0x92afb7 = search(r'_0x92afb7="(.*?)"', html)
-            _0x1cdcb3 = search(r'_0x1cdcb3="(.*?)"', html)
-            _0x31f1b4 = search(r'_0x31f1b4="(.*?)"', html)
-            _0x4817e7 = search(r'_0x4817e7="(.*?)"', html)
-            _0x2c6182 = search(r'_0x2c6182="(.*?)"', html)
-            _0x53e80d = search(r'_0x53e80d="(.*?)"', html)
-            _0x375c1e = search(r'_0x375c1e="(.*?)"', html)
-            _0x16777a = search(r'_0x16777a="(.*?)"', html)
-            _0x14ff50 = search(r'_0x14ff50="(.*?)"', html)
-            _0x18dc18 = search(r'_0x18dc18="(.*?)"', html)
-
-            _0x541840 = _0x53e80d + _0x16777a + _0x92afb7 + _0x31f1b4
-            _0x51318f = _0x375c1e + _0x14ff50 + _0x4817e7
-            _0x574bee = _0x51318f + _0x541840 + _0x18dc18 + _0x2c6182
-
-            return base64.b64decode(_0x574bee)
-        except binascii.Error as ex:
-            print(ex)
-            traceback.print_exc()
-            return ''
-
-    def get_post_param(self, html):
-        _0x161539 = search("_0x161539='(.*?)'", html)
-        _0xac7006 = search("_0xac7006='(.*?)'", html)
-
-        return _0x161539 + _0xac7006
-
-    def get_image_url(self, html):
-        _0xDB36 = search('_0xDB36="(.*?)"', html)
-        _0xDB54 = search('_0xDB54="(.*?)"', html)
-        return _0xDB36 + '/img/' + _0xDB54
-
-
-class ImgView(AbstractProvider):
-    DOMEN = "imgview"
-
-    def __init__(self):
-        super().__init__()
-
-    def get_host(self):
-        return "imgview.pw"
-
-    def get_domen(self):
-        return ImgView.DOMEN
-
-    def get_redirect_url(self, html):
-        try:
-            _0x474995 = search(r'_0x474995="(.*?)"', html)
-            _0x105bd2 = search(r'_0x105bd2="(.*?)"', html)
-            _0x5f000f = search(r'_0x5f000f="(.*?)"', html)
-            _0x5f4353 = search(r'_0x5f4353="(.*?)"', html)
-            _0x39b490 = search(r'_0x39b490="(.*?)"', html)
-            _0x51ca4d = search(r'_0x51ca4d="(.*?)"', html)
-            _0x3edc55 = search(r'_0x3edc55="(.*?)"', html)
-            _0x2091c4 = search(r'_0x2091c4="(.*?)"', html)
-            _0x388eb7 = search(r'_0x388eb7="(.*?)"', html)
-            _0x308cf0 = search(r'_0x308cf0="(.*?)"', html)
-
-            _0x33d616 = _0x51ca4d + _0x2091c4 + _0x474995 + _0x5f000f
-            _0x1dbdb1 = _0x3edc55 + _0x388eb7 + _0x5f4353
-            _0x180c90 = _0x1dbdb1 + _0x33d616 + _0x308cf0 + _0x39b490
-
-            return base64.b64decode(_0x180c90)
-        except binascii.Error as ex:
-            print(ex)
-            traceback.print_exc()
-            return ''
-
-    def get_post_param(self, html):
-        _0x6f3649 = search("_0x6f3649='(.*?)'", html)
-        _0x5754e8 = search("_0x5754e8='(.*?)'", html)
-        _0x58bd37 = search("_0x58bd37='(.*?)'", html)
-        _0x23f325 = search("_0x23f325='(.*?)'", html)
-        _0x3e41de = search("_0x3e41de='(.*?)'", html)
-        _0x1728a8 = search("_0x1728a8='(.*?)'", html)
-        _0x46dc6a = search("_0x46dc6a='(.*?)'", html)
-        _0x2a20de = search("_0x2a20de='(.*?)'", html)
-        _0x1a0961 = search("_0x1a0961='(.*?)'", html)
-        _0x1008b5 = search("_0x1008b5='(.*?)'", html)
-        _0x301249 = search("_0x301249='(.*?)'", html)
-
-        return _0x6f3649 + _0x5754e8 + _0x58bd37 + _0x23f325 + _0x3e41de + _0x1728a8 + _0x46dc6a + _0x2a20de + _0x1a0961 + _0x1008b5 + _0x301249
-
-    def get_image_url(self, html):
-        return search(r'>Next.+?<img src="(.*?)" class="picview" alt=', html)
-
-
-class ImgTown(AbstractProvider):
-    DOMEN = "imgtown"
-
-    def __init__(self):
-        super().__init__()
-
-    def get_host(self):
-        return "imgtown.pw"
-
-    def get_domen(self):
-        return ImgTown.DOMEN
-
-    def get_redirect_url(self, html):
-        try:
-            _0x92afb7 = search(r'_0x92afb7="(.*?)"', html)
-            _0x1cdcb3 = search(r'_0x1cdcb3="(.*?)"', html)
-            _0x31f1b4 = search(r'_0x31f1b4="(.*?)"', html)
-            _0x4817e7 = search(r'_0x4817e7="(.*?)"', html)
-            _0x2c6182 = search(r'_0x2c6182="(.*?)"', html)
-            _0x53e80d = search(r'_0x53e80d="(.*?)"', html)
-            _0x375c1e = search(r'_0x375c1e="(.*?)"', html)
-            _0x16777a = search(r'_0x16777a="(.*?)"', html)
-            _0x14ff50 = search(r'_0x14ff50="(.*?)"', html)
-            _0x18dc18 = search(r'_0x18dc18="(.*?)"', html)
-
-            _0x541840 = _0x53e80d + _0x16777a + _0x92afb7 + _0x31f1b4
-            _0x51318f = _0x375c1e + _0x14ff50 + _0x4817e7
-            _0x574bee = _0x51318f + _0x541840 + _0x18dc18 + _0x2c6182
-
-            return base64.b64decode(_0x574bee)
-        except binascii.Error as ex:
-            print(ex)
-            traceback.print_exc()
-            return ''
-
-    def get_post_param(self, html):
-        _0x6f3649 = search("_0x6f3649='(.*?)'", html)
-        _0x5754e8 = search("_0x5754e8='(.*?)'", html)
-        _0x58bd37 = search("_0x58bd37='(.*?)'", html)
-        _0x23f325 = search("_0x23f325='(.*?)'", html)
-        _0x3e41de = search("_0x3e41de='(.*?)'", html)
-        _0x1728a8 = search("_0x1728a8='(.*?)'", html)
-        _0x46dc6a = search("_0x46dc6a='(.*?)'", html)
-        _0x2a20de = search("_0x2a20de='(.*?)'", html)
-        _0x1a0961 = search("_0x1a0961='(.*?)'", html)
-        _0x1008b5 = search("_0x1008b5='(.*?)'", html)
-        _0x301249 = search("_0x301249='(.*?)'", html)
-
-        return _0x6f3649 + _0x5754e8 + _0x58bd37 + _0x23f325 + _0x3e41de + _0x1728a8 + _0x46dc6a + _0x2a20de + _0x1a0961 + _0x1008b5 + _0x301249
-
-    def get_image_url(self, html):
-        return search(r'>Next.+?<img src="(.*?)" class="picview" alt=', html)
-
-
-class ImgOutlet(AbstractProvider):
-    DOMEN = "imgoutlet"
-
-    def __init__(self):
-        super().__init__()
-
-    def get_host(self):
-        return "imgoutlet.pw"
-
-    def get_domen(self):
-        return ImgOutlet.DOMEN
-
-    def get_redirect_url(self, html):
-        try:
-            _0x4ae180 = search(r'_0x4ae180="(.*?)"', html)
-            _0x31c497 = search(r'_0x31c497="(.*?)"', html)
-            _0x580e37 = search(r'_0x580e37="(.*?)"', html)
-            _0x337490 = search(r'_0x337490="(.*?)"', html)
-            _0x5aa778 = search(r'_0x5aa778="(.*?)"', html)
-            _0x4c78db = search(r'_0x4c78db="(.*?)"', html)
-            _0x5f2b0 = search(r'_0x5f2b0="(.*?)"', html)
-            _0x19792c = search(r'_0x19792c="(.*?)"', html)
-            _0x269158 = search(r'_0x269158="(.*?)"', html)
-            _0xacf574 = search(r'_0xacf574="(.*?)"', html)
-
-            _0x3ec3bd = _0x4c78db + _0x19792c + _0x4ae180 + _0x580e37
-            _0x5051f4 = _0x5f2b0 + _0x269158 + _0x337490
-            _0x1587cc = _0x5051f4 + _0x3ec3bd + _0xacf574 + _0x5aa778
-
-            return base64.b64decode(_0x1587cc)
-        except binascii.Error as ex:
-            print(ex)
-            traceback.print_exc()
-            return ''
-
-    def get_post_param(self, html):
-        _0x161539 = search("_0x161539='(.*?)'", html)
-        _0xac7006 = search("_0xac7006='(.*?)'", html)
-
-        return _0x161539 + _0xac7006
-
-    def get_image_url(self, html):
-        _0xDB36 = search('_0xDB36="(.*?)"', html)
-        _0xDB54 = search('_0xDB54="(.*?)"', html)
-        return _0xDB36 + '/img/' + _0xDB54
-
-
-class ImgMaze(AbstractProvider):
-    DOMEN = "imgmaze"
-
-    def __init__(self):
-        super().__init__()
-
-    def get_host(self):
-        return "imgmaze.pw"
-
-    def get_domen(self):
-        return ImgMaze.DOMEN
-
-    def get_redirect_url(self, html):
+    for future in futures:
         try:
-            _0x1ab2d2 = search(r'_0x1ab2d2="(.*?)"', html)
-            _0x2b3b4c = search(r'_0x2b3b4c="(.*?)"', html)
-            _0x3b4d44 = search(r'_0x3b4d44="(.*?)"', html)
-            _0x43582a = search(r'_0x43582a="(.*?)"', html)
-            _0x501afd = search(r'_0x501afd="(.*?)"', html)
-            _0x23d671 = search(r'_0x23d671="(.*?)"', html)
-            _0x220856 = search(r'_0x220856="(.*?)"', html)
-            _0x473131 = search(r'_0x473131="(.*?)"', html)
-            _0x421cf1 = search(r'_0x421cf1="(.*?)"', html)
-            _0x86fd3f = search(r'_0x86fd3f="(.*?)"', html)
-
-            _0x15e3ee = _0x23d671 + _0x473131 + _0x1ab2d2 + _0x3b4d44
-            _0x5d3c98 = _0x220856 + _0x421cf1 + _0x43582a
-            _0x358455 = _0x5d3c98 + _0x15e3ee + _0x86fd3f + _0x501afd
-
-            return base64.b64decode(_0x358455)
-        except binascii.Error as ex:
-            print(ex)
+            future.result()
+        except CancelledError:
+            pass
+        except BaseException as error:
+            print(error)
             traceback.print_exc()
-            return ''
 
-    def get_post_param(self, html):
-        _0x6f3649 = search("_0x6f3649='(.*?)'", html)
-        _0x5754e8 = search("_0x5754e8='(.*?)'", html)
-        _0x58bd37 = search("_0x58bd37='(.*?)'", html)
-        _0x23f325 = search("_0x23f325='(.*?)'", html)
-        _0x3e41de = search("_0x3e41de='(.*?)'", html)
-        _0x1728a8 = search("_0x1728a8='(.*?)'", html)
-        _0x46dc6a = search("_0x46dc6a='(.*?)'", html)
-        _0x2a20de = search("_0x2a20de='(.*?)'", html)
-        _0x1a0961 = search("_0x1a0961='(.*?)'", html)
-        _0x1008b5 = search("_0x1008b5='(.*?)'", html)
-        _0x301249 = search("_0x301249='(.*?)'", html)
 
-        return _0x6f3649 + _0x5754e8 + _0x58bd37 + _0x23f325 + _0x3e41de + _0x1728a8 + _0x46dc6a + _0x2a20de + _0x1a0961 + _0x1008b5 + _0x301249
+def fill_button(disk_cache, click, btn, url, img_url, token):
+    """Paints the thumbnail of img_url on the button, a click on it calls click(url)"""
+    bg_color = "green"
+    img_resized = image_cache.get(img_url, IMG_WIDTH)
+    if img_resized is None:
+        filename = get_thumb_key(img_url)
+        img_file = disk_cache.open(filename)
+        if img_file is None:
+            if disk_cache.is_dead(img_url):
+                return
 
-    def get_image_url(self, html):
-        return search(r'>Next.+?<img src="(.*?)" class="picview" alt=', html)
+            image = engine.call(engine.download_image(img_url, stage='thumb'), token)
+            if image is None:
+                disk_cache.mark_dead(img_url)
+                return
 
+            if len(image) == 0:
+                return
 
-class ImgDew(AbstractProvider):
-    DOMEN = "imgdew"
+            disk_cache.put(filename, image, 'thumb')
+            img_file = io.BytesIO(image)
+            bg_color = "red"
 
-    def __init__(self):
-        super().__init__()
+        token.check()
+        with img_file:
+            img_resized, _ = open_scaled(img_file, IMG_WIDTH)
+        image_cache.put(img_url, IMG_WIDTH, img_resized)
 
-    def get_host(self):
-        return "imgdew.pw"
+    photo_image = ImageTk.PhotoImage(img_resized)
+    if photo_image is None:
+        return
 
-    def get_domen(self):
-        return ImgDew.DOMEN
+    after_idle(token, btn.set_values, url, partial(click, url), photo_image, bg_color)
 
-    def get_redirect_url(self, html):
-        try:
-            _0x474995 = search(r'_0x474995="(.*?)"', html)
-            _0x105bd2 = search(r'_0x105bd2="(.*?)"', html)
-            _0x5f000f = search(r'_0x5f000f="(.*?)"', html)
-            _0x5f4353 = search(r'_0x5f4353="(.*?)"', html)
-            _0x39b490 = search(r'_0x39b490="(.*?)"', html)
-            _0x51ca4d = search(r'_0x51ca4d="(.*?)"', html)
-            _0x3edc55 = search(r'_0x3edc55="(.*?)"', html)
-            _0x2091c4 = search(r'_0x2091c4="(.*?)"', html)
-            _0x388eb7 = search(r'_0x388eb7="(.*?)"', html)
-            _0x308cf0 = search(r'_0x308cf0="(.*?)"', html)
-
-            _0x33d616 = _0x51ca4d + _0x2091c4 + _0x474995 + _0x5f000f
-            _0x1dbdb1 = _0x3edc55 + _0x388eb7 + _0x5f4353
-            _0x180c90 = _0x1dbdb1 + _0x33d616 + _0x308cf0 + _0x39b490
-
-            return base64.b64decode(_0x180c90)
-        except binascii.Error as ex:
-            print(ex)
-            traceback.print_exc()
-            return ''
 
-    def get_post_param(self, html):
-        _0x6f3649 = search("_0x6f3649='(.*?)'", html)
-        _0x5754e8 = search("_0x5754e8='(.*?)'", html)
-        _0x58bd37 = search("_0x58bd37='(.*?)'", html)
-        _0x23f325 = search("_0x23f325='(.*?)'", html)
-        _0x3e41de = search("_0x3e41de='(.*?)'", html)
-        _0x1728a8 = search("_0x1728a8='(.*?)'", html)
-        _0x46dc6a = search("_0x46dc6a='(.*?)'", html)
-        _0x2a20de = search("_0x2a20de='(.*?)'", html)
-        _0x1a0961 = search("_0x1a0961='(.*?)'", html)
-        _0x1008b5 = search("_0x1008b5='(.*?)'", html)
-        _0x301249 = search("_0x301249='(.*?)'", html)
+def after_idle(token, func, *args):
+    """root.after_idle for a result of a load, dropped if the load was cancelled or replaced meanwhile"""
+    root.after_idle(run_if_current, token, func, args)
 
-        return _0x6f3649 + _0x5754e8 + _0x58bd37 + _0x23f325 + _0x3e41de + _0x1728a8 + _0x46dc6a + _0x2a20de + _0x1a0961 + _0x1008b5 + _0x301249
 
-    def get_image_url(self, html):
-        return search(r'>Next.+?<img src="(.*?)" class="picview" alt=', html)
+def run_if_current(token, func, args):
+    if not token.cancelled:
+        func(*args)
 
 
 class GalleryWindow:
@@ -1192,6 +774,8 @@ class GalleryWindow:
         self.page = 1
         self.page_count = GalleryWindow.INFINITY
         self.provider = parent.provider
+        self.prefetcher = GalleryPrefetcher(CACHE, IMG_WIDTH)
+        self.token = LoadToken()
 
         self.btn_reload = Button(frm_top, text="Reload",
                                  command=lambda: self.show_page_in_thread(self.sv_page.get().strip(), True))
@@ -1228,13 +812,13 @@ class GalleryWindow:
 
     def show_page_in_thread(self, page, ignore_cache=False):
         self.set_controls_state(DISABLED)
-        future = executor.submit(self.show_page, page, ignore_cache)
-        future.add_done_callback(lambda f: self.set_controls_state(NORMAL))
-
-    def show_page(self, page, ignore_cache):
-        global root
+        self.token.cancel()
+        self.token = token = LoadToken()
+        future = token.add(executor.submit(self.show_page, page, ignore_cache, token))
+        future.add_done_callback(lambda f: self.set_controls_state(NORMAL) if token is self.token else None)
 
-        root.after_idle(self.frm_bottom.scroll_top_left)
+    def show_page(self, page, ignore_cache, token):
+        after_idle(token, self.frm_bottom.scroll_top_left)
 
         self.page = int(page)
 
@@ -1245,42 +829,80 @@ class GalleryWindow:
         #     self.page = self.page_count
 
         try:
-            filename = f'{self.gallery}_{self.page:05}'
+            filename = get_gallery_key(self.gallery, self.page)
             html = self.get_from_cache(filename)
-            if ignore_cache or (html is None) or (len(html) == 0):
-                url = f'https://{self.provider.get_host()}/?fld_hash={self.gallery}&' \
-                      f'op=gallery&per_page=15&page={self.page}'
-                response = requests.get(url, proxies=self.parent_window.proxies, timeout=TIMEOUT)
-                if response.status_code == 404:
-                    print("gallery url response.status_code == 404")
+            revalidation = None
+            if (html is None) or (len(html) == 0):
+                html = self.download_page(self.page, token)
+                if html is None:
                     return False
+            elif ignore_cache or not self.is_fresh(filename):
+                # show the stale copy right away, the server is asked meanwhile
+                revalidation = token.add(executor.submit(self.download_page, self.page, token))
 
-                html = response.content
-                self.put_to_cache(filename, html)
-
-            html = html.decode('utf-8')
-
-            if self.page_count == GalleryWindow.INFINITY or ignore_cache:
-                total = search('<small>\(([0-9]+) total\)</small>', html)
-                if (total is not None) and (len(total) > 0):
-                    self.page_count = int(math.ceil(int(total) / 15))
-                else:
-                    self.page_count = 1
+            page_count = self.render_page(html.decode('utf-8'), ignore_cache, token)
 
-            tab = search('<Table class="file_block">(.*?)</Table>', html)
-            self.reconfigure_buttons(self.image_buttons, tab)
+            self.prefetcher.move(self.provider, self.gallery, self.page, page_count,
+                                 self.parent_window.proxies)
 
-            self.window.title(f'{self.gallery} ({self.page_count})')
+            if revalidation is not None:
+                # repainted only after the stale render is done, so none of its paints land after the fresh ones
+                self.repaint_page(revalidation, token)
 
+        except CancelledError:
+            return False
         except BaseException as error:
             print(error)
             traceback.print_exc()
             return False
 
-        root.after_idle(self.sv_page.set, self.page)
+        after_idle(token, self.sv_page.set, self.page)
 
         return True
 
+    def download_page(self, page, token):
+        """Returns the page if the server sent one, a prefetch of the same page is joined rather than repeated"""
+        response = engine.call(engine.download_gallery_page(self.provider, self.gallery, page,
+                                                            get_cache(CACHE, self.provider.get_domen()),
+                                                            self.parent_window.proxies), token)
+        if response.status_code == 404:
+            print("gallery url response.status_code == 404")
+            return None
+
+        if response.status_code != 200:
+            return None
+
+        return response.content
+
+    def repaint_page(self, revalidation, token):
+        try:
+            html = revalidation.result()
+        except CancelledError:
+            raise
+        except BaseException as error:
+            print(error)
+            traceback.print_exc()
+            return
+
+        if html is not None:
+            self.render_page(html.decode('utf-8'), True, token)
+
+    def render_page(self, html, count_pages, token):
+        """Returns the page count, it is set along with the title on the Tk thread"""
+        page_count = self.page_count
+        if page_count == GalleryWindow.INFINITY or count_pages:
+            page_count = get_page_count(html, GALLERY_PAGE_SIZE)
+
+        self.reconfigure_buttons(self.image_buttons, get_gallery_links(html), token)
+
+        after_idle(token, self.set_page_count, page_count)
+
+        return page_count
+
+    def set_page_count(self, page_count):
+        self.page_count = page_count
+        self.window.title(f'{self.gallery} ({page_count})')
+
     def fill_panel(self, panel):
         buttons = []
         for i in range(8):
@@ -1325,76 +947,31 @@ class GalleryWindow:
         self.top_buttons.append(btn)
 
     def on_close(self):
+        self.token.cancel()
+        self.prefetcher.cancel()
         self.window.update_idletasks()
         self.window.destroy()
 
-    def reconfigure_button(self, http_session, btn, url, img_url):
-        global root
-
-        filename = get_filename(img_url)
-        dot_pos = filename.rfind('.')
-        filename = filename[: dot_pos]
-        bg_color = "green"
-        image = self.get_from_cache(filename)
-        if (image is None) or (len(image) == 0):
-            image = download_image(http_session, img_url)
-            self.put_to_cache(filename, image)
-            bg_color = "red"
-
-        if (image is None) or (len(image) == 0):
-            return
-
-        img = Image.open(io.BytesIO(image))
-        w, h = img.size
-        k = IMG_WIDTH / w
-        img_resized = img.resize((IMG_WIDTH, int(h * k)))
-        photo_image = ImageTk.PhotoImage(img_resized)
-        if photo_image is None:
-            return
-
-        root.after_idle(btn.set_values, url, partial(self.load_image, url),
-                        photo_image, bg_color)
+    def reconfigure_button(self, btn, url, img_url, token):
+        fill_button(get_cache(CACHE, self.provider.get_domen()), self.load_image, btn, url, img_url, token)
 
     def load_image(self, url):
         self.parent_window.load_page_in_thread(url)
 
-    def reconfigure_buttons(self, buttons, html):
-        http_session = requests.Session()
-        http_session.headers.update(HEADERS)
-
-        try:
-            for btn in buttons:
-                btn.reset()
+    def reconfigure_buttons(self, buttons, links, token):
+        for btn in buttons:
+            btn.reset()
 
-            i = 0
-            for m in re.finditer('<TD>.*?href="(.*?)".*?src="(.*?)".*?</TD>', html, re.MULTILINE | re.DOTALL):
-                self.reconfigure_button(http_session, buttons[i], m.group(1), m.group(2))
-                i += 1
-        except BaseException as error:
-            print(error)
-            traceback.print_exc()
-        finally:
-            http_session.close()
+        fill_buttons(partial(self.reconfigure_button, token=token), buttons, links, token)
 
     def get_from_cache(self, filename):
-        full_path = os.path.join(CACHE, self.provider.get_domen(), filename)
-        if not os.path.exists(full_path):
-            return None
-
-        mod_time = time.time()
-        os.utime(full_path, (mod_time, mod_time))
-
-        with open(full_path, 'rb') as f:
-            return f.read()[:: -1]
-
-    def put_to_cache(self, filename, data):
-        if (data is None) or (len(data) == 0):
-            return
+        return get_cache(CACHE, self.provider.get_domen()).get(filename)
 
-        full_path = os.path.join(CACHE, self.provider.get_domen(), filename)
+    def put_to_cache(self, filename, data, content_type=None):
+        get_cache(CACHE, self.provider.get_domen()).put(filename, data, content_type)
 
-        with open(full_path, 'wb') as f:
-            f.write(data[:: -1])
+    def is_fresh(self, filename):
+        return get_cache(CACHE, self.provider.get_domen()).is_fresh(filename)
 
     def enter_callback(self, event):
         self.show_page_in_thread(self.sv_page.get().strip())
@@ -0,0 +1,299 @@
+"""Fills the cache for whole galleries without the UI
+
+    python warm.py [-j JOBS] [-o] [-p PROXY|@FILE ...] [-r PROGRESS] URL|@FILE ...
+
+URL is a gallery url (.../g/<hash>) or an image page url, @FILE reads urls from a file, one per line.
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+import traceback
+
+from cache import get_cache
+from engine import engine
+from fetch import GALLERY_PAGE_SIZE, DeadLinkError, get_page_model, get_thumb_key, get_original_key, get_gallery_key
+from page import get_page_count, get_gallery_links
+from providers import get_provider, get_id
+from proxy import ProxyPool, read_addresses
+
+CACHE = 'cache'
+LOGS = 'logs'
+JOBS = 32
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = {}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def get(self, name):
+        with self.lock:
+            return self.counts.get(name, 0)
+
+    def print_summary(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        hits = self.get('hits')
+        misses = self.get('misses')
+        lookups = max(hits + misses, 1)
+        downloaded = self.get('bytes')
+
+        print(f"gallery pages: {self.get('gallery pages')}, image pages: {self.get('pages')}, "
+              f"thumbnails: {self.get('thumbs')}, originals: {self.get('originals')}")
+        print(f"dead: {self.get('dead')}, failed: {self.get('failed')}, skipped: {self.get('skipped')}")
+        print(f"hit rate: {100 * hits / lookups:.1f}% ({hits} hits, {misses} misses)")
+        print(f"downloaded {downloaded / 1024 / 1024:.1f} MiB in {elapsed:.1f}s "
+              f"({downloaded / 1024 / elapsed:.1f} KiB/s, {(hits + misses) / elapsed:.1f} entries/s)")
+
+
+class Progress:
+    """Idents warmed by earlier runs, appended as they are done so an interrupted run can resume"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+
+        if (path is not None) and os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.strip() for line in f if len(line.strip()) > 0}
+
+    def is_done(self, key):
+        with self.lock:
+            return key in self.done
+
+    def set_done(self, key):
+        with self.lock:
+            if key in self.done:
+                return
+            self.done.add(key)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(key + '\n')
+
+
+class Warmer:
+    """Warms pages as coroutines on the fetch engine, at most jobs of them at a time"""
+
+    def __init__(self, jobs, originals, proxies, progress):
+        self.jobs = jobs
+        self.originals = originals
+        self.proxies = proxies
+        self.progress = progress
+        self.stats = Stats()
+        self.semaphore = None
+
+    def warm(self, urls):
+        engine.call(self.warm_all(urls))
+
+    async def warm_all(self, urls):
+        self.semaphore = asyncio.Semaphore(self.jobs)
+
+        tasks = []
+        for url in urls:
+            provider = get_provider(url)
+            if provider is None:
+                print("unknown provider: " + url)
+                continue
+
+            g_spot = url.find('/g/')
+            if g_spot >= 0:
+                tasks.extend(await self.warm_gallery(provider, url[g_spot + 3:].strip('/')))
+            else:
+                tasks.append(asyncio.ensure_future(self.warm_page(provider, url)))
+
+        await asyncio.gather(*tasks)
+
+    async def warm_gallery(self, provider, gallery):
+        """Crawls the gallery pages one by one and starts warming their image pages, returns the tasks"""
+        tasks = []
+        page = 1
+        page_count = 1
+        while page <= page_count:
+            html = await self.get_gallery_page(provider, gallery, page)
+            if html is None:
+                break
+
+            page_count = get_page_count(html, GALLERY_PAGE_SIZE)
+            for url, img_url in get_gallery_links(html):
+                tasks.append(asyncio.ensure_future(self.warm_thumb(provider, img_url)))
+                tasks.append(asyncio.ensure_future(self.warm_page(provider, url)))
+
+            print(f"{gallery}: page {page}/{page_count}")
+            page += 1
+
+        return tasks
+
+    async def get_gallery_page(self, provider, gallery, page):
+        disk_cache = get_cache(CACHE, provider.get_domen())
+        key = get_gallery_key(gallery, page)
+        html = disk_cache.get(key)
+        if (html is not None) and (len(html) > 0) and disk_cache.is_fresh(key):
+            self.stats.add('hits')
+            return html.decode('utf-8')
+
+        self.stats.add('misses')
+        try:
+            # revalidates the stale copy and joins a fetch of the same page already in flight
+            response = await engine.download_gallery_page(provider, gallery, page, disk_cache, self.proxies)
+        except BaseException as error:
+            print(f"{gallery}: page {page} {error}")
+            return None
+
+        if (response.status_code == 304) and (html is not None) and (len(html) > 0):
+            return html.decode('utf-8')
+
+        if response.status_code != 200:
+            print(f"{gallery}: page {page} response.status_code == {response.status_code}")
+            return None
+
+        html = response.content
+        self.stats.add('bytes', len(html))
+        self.stats.add('gallery pages')
+
+        return html.decode('utf-8')
+
+    async def warm_page(self, provider, url):
+        ident = get_id(provider, url)
+        if ident is None:
+            print("ident is None: " + url)
+            return
+
+        done_key = f'{provider.get_domen()}/{ident}' + ('/o' if self.originals else '')
+        if self.progress.is_done(done_key):
+            self.stats.add('skipped')
+            return
+
+        disk_cache = get_cache(CACHE, provider.get_domen())
+        try:
+            if disk_cache.is_dead(ident):
+                self.stats.add('dead')
+                return
+
+            model = get_page_model(disk_cache, provider, ident)
+            if model is not None:
+                self.stats.add('hits')
+            else:
+                self.stats.add('misses')
+                input_url = "https://" + provider.get_host() + "/" + ident
+                async with self.semaphore:
+                    model = await engine.resolve_page(provider, ident, input_url, self.proxies, disk_cache)
+                if model is None:
+                    self.stats.add('failed')
+                    return
+                self.stats.add('pages')
+
+            if not await self.warm_thumb(provider, model.thumb_url):
+                # not done, a resumed run tries the thumbnail again
+                return
+            if self.originals and (len(model.image_url) > 0):
+                await self.warm_image(disk_cache, get_original_key(model.image_url, ident), model.image_url,
+                                      'originals')
+
+            self.progress.set_done(done_key)
+        except DeadLinkError:
+            self.stats.add('dead')
+        except BaseException as error:
+            print("Exception URL: " + url)
+            print(error)
+            traceback.print_exc()
+            self.stats.add('failed')
+
+    async def warm_thumb(self, provider, img_url):
+        """Returns False when the thumbnail couldn't be fetched"""
+        if len(img_url) == 0:
+            return True
+
+        disk_cache = get_cache(CACHE, provider.get_domen())
+        try:
+            await self.warm_image(disk_cache, get_thumb_key(img_url), img_url, 'thumbs')
+        except BaseException as error:
+            print("Exception URL: " + img_url)
+            print(error)
+            self.stats.add('failed')
+            return False
+
+        return True
+
+    async def warm_image(self, disk_cache, key, img_url, counter):
+        if disk_cache.contains(key):
+            self.stats.add('hits')
+            return
+
+        if disk_cache.is_dead(img_url):
+            self.stats.add('dead')
+            return
+
+        self.stats.add('misses')
+        async with self.semaphore:
+            image = await engine.download_image(img_url, self.proxies, 'image' if counter == 'originals' else 'thumb')
+        if image is None:
+            disk_cache.mark_dead(img_url)
+            self.stats.add('dead')
+            return
+
+        disk_cache.put(key, image, 'image' if counter == 'originals' else 'thumb')
+        self.stats.add('bytes', len(image))
+        self.stats.add(counter)
+
+
+def read_urls(args):
+    urls = []
+    for arg in args:
+        if arg.startswith('@'):
+            with open(arg[1:]) as f:
+                urls.extend(line.strip() for line in f if len(line.strip()) > 0)
+        else:
+            urls.append(arg)
+
+    return urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the cache for galleries and image pages")
+    parser.add_argument('urls', nargs='+', help="gallery or image page urls, @file reads urls from a file")
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS, help="requests in flight at a time")
+    parser.add_argument('-o', '--originals', action='store_true', help="download original images too")
+    parser.add_argument('-p', '--proxy', action='append', default=[],
+                        help="host:port of a proxy to use, repeat it or use @file for a pool")
+    parser.add_argument('-r', '--progress', default=os.path.join(LOGS, 'warm.txt'),
+                        help="file with the pages already done, appended while running")
+    args = parser.parse_args()
+
+    proxies = None
+    if len(args.proxy) > 0:
+        addresses = []
+        for arg in args.proxy:
+            if arg.startswith('@'):
+                addresses.extend(read_addresses(arg[1:]))
+            else:
+                addresses.append(arg)
+        proxies = ProxyPool(addresses)
+        probes = engine.submit(proxies.probe_forever(engine))
+
+    os.makedirs(CACHE, exist_ok=True)
+    os.makedirs(LOGS, exist_ok=True)
+
+    warmer = Warmer(args.jobs, args.originals, proxies, Progress(args.progress))
+    try:
+        warmer.warm(read_urls(args.urls))
+    except KeyboardInterrupt:
+        print("interrupted")
+    finally:
+        warmer.stats.print_summary()
+        if proxies is not None:
+            probes.cancel()
+            proxies.save_stats()
+            proxies.print_stats()
+        engine.print_stats()
+        engine.close()
+
+
+if __name__ == "__main__":
+    main()